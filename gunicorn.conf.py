@@ -1,10 +1,34 @@
+import os
+
 bind = "unix:/run/gunicorn.sock"
 workers = 3
 
 accesslog = "gunicorn.access.log"
+# The default format plus the request time in microseconds, read by
+# `manage.py analyze_access_log`
+access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s" %(D)s'
 errorlog = "gunicorn.error.log"
 
 # Whether to send Django output to the error log 
 capture_output = True
 # How verbose the Gunicorn error logs should be (debug, info, warning, error, critical)
 loglevel = "info"
+
+
+def on_starting(server):
+    # The metrics of the previous run would be added to the new ones
+    import shutil
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "itacpc.settings")
+    from django.conf import settings
+
+    server.metrics_dir = settings.METRICS_DIR
+    shutil.rmtree(server.metrics_dir, ignore_errors=True)
+
+
+def child_exit(server, worker):
+    # Forget the requests that were in progress in the worker (see teams/metrics.py)
+    try:
+        os.remove(os.path.join(server.metrics_dir, f"gauge_{worker.pid}.db"))
+    except FileNotFoundError:
+        pass
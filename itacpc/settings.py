@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
 import os
+import tempfile
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -51,6 +52,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "teams.metrics.MetricsMiddleware",
+    "teams.profiling.ProfilingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -61,6 +64,17 @@ MIDDLEWARE = [
     "allauth.account.middleware.AccountMiddleware",
 ]
 
+# Per-request profiling (see teams/profiling.py): Server-Timing header for
+# staff users, and JSON records of a sample of the requests in the log
+PROFILING_ENABLED = eval(os.getenv("PROFILING_ENABLED", default="False"))
+PROFILING_SAMPLE_RATE = eval(os.getenv("PROFILING_SAMPLE_RATE", default="0.01"))
+PROFILING_SLOW_MS = eval(os.getenv("PROFILING_SLOW_MS", default="1000"))
+
+# Prometheus metrics (see teams/metrics.py), served at /metrics to staff users
+# and to localhost. Every worker process keeps its values in METRICS_DIR.
+METRICS_ENABLED = eval(os.getenv("METRICS_ENABLED", default="True"))
+METRICS_DIR = os.getenv("METRICS_DIR", default=os.path.join(tempfile.gettempdir(), "itacpc-metrics"))
+
 ROOT_URLCONF = "itacpc.urls"
 
 TEMPLATES = [
@@ -100,6 +114,9 @@ DATABASES = {
     'dev': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Take the write lock when the transaction starts, otherwise concurrent
+        # transactions that read before writing fail with "database is locked"
+        'OPTIONS': {'transaction_mode': 'IMMEDIATE'},
     },
     'production': {
         'ENGINE': 'django.db.backends.postgresql',
@@ -114,6 +131,25 @@ DATABASES = {
 DATABASES['default'] = DATABASES['dev' if DEBUG else 'production']
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# On disk, so that the pages cached by a worker are served by the others too
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.getenv("CACHE_DIR", default=os.path.join(tempfile.gettempdir(), "itacpc-cache")),
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+}
+
+# Files produced by the background jobs (see teams/jobs.py), e.g. the exports
+ARTIFACTS_DIR = os.getenv("ARTIFACTS_DIR", default=str(BASE_DIR / "artifacts"))
+# URL prefix of the internal nginx location serving ARTIFACTS_DIR: downloads
+# are then sent by nginx (with X-Accel-Redirect) instead of by a worker
+ARTIFACTS_ACCEL_REDIRECT = os.getenv("ARTIFACTS_ACCEL_REDIRECT", default="" if DEBUG else "/artifacts/")
+
+
 # Custom user
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-user-model
 
@@ -167,17 +203,24 @@ LOGOUT_REDIRECT_URL = "/"
 
 # Email
 if DEBUG:
-    EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+    OUTBOX_EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
     DEFAULT_FROM_EMAIL = "itacpc@olinfo.it"
 else:
-    EMAIL_BACKEND = "sgbackend.SendGridBackend"
+    OUTBOX_EMAIL_BACKEND = "sgbackend.SendGridBackend"
     SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY")
     DEFAULT_FROM_EMAIL = "info@itacpc.it"
 
-# EMAIL_HOST = os.getenv("EMAIL_HOST")
-# EMAIL_PORT = os.getenv("EMAIL_PORT")
-# EMAIL_HOST_USER = os.getenv("EMAIL_HOST_USER")
-# EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD")
+# With the outbox, requests only store the emails in the DB and `manage.py
+# send_outbox` delivers them through OUTBOX_EMAIL_BACKEND
+EMAIL_OUTBOX = eval(os.getenv("EMAIL_OUTBOX", default=str(not DEBUG)))
+EMAIL_BACKEND = "teams.mail.OutboxEmailBackend" if EMAIL_OUTBOX else OUTBOX_EMAIL_BACKEND
+
+# Only used by the SMTP backend, e.g. `manage.py send_outbox --backend
+# django.core.mail.backends.smtp.EmailBackend` against a local SMTP server
+EMAIL_HOST = os.getenv("EMAIL_HOST", default="localhost")
+EMAIL_PORT = int(os.getenv("EMAIL_PORT", default="25"))
+EMAIL_HOST_USER = os.getenv("EMAIL_HOST_USER", default="")
+EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD", default="")
 
 # Django-allauth
 # https://docs.allauth.org/en/latest/account/configuration.html
@@ -192,6 +235,12 @@ ACCOUNT_ADAPTER = 'teams.adapters.StudentAccountAdapter'
 REGISTRATION_IS_CLOSED = eval(os.getenv("REGISTRATION_IS_CLOSED", default="False"))
 CAN_DISCLOSE_CREDENTIALS = eval(os.getenv("CAN_DISCLOSE_CREDENTIALS", default="False"))
 
+# Contest credentials are either random and saved on the first export
+# ("stored") or derived from the user id and CREDENTIALS_SECRET ("hmac"), see
+# teams/credentials.py. Use a new secret for every edition.
+CREDENTIALS_ENGINE = os.getenv("CREDENTIALS_ENGINE", default="stored")
+CREDENTIALS_SECRET = os.getenv("CREDENTIALS_SECRET", default="")
+
 # Prod stuff
 if not DEBUG:
     SECURE_HSTS_PRELOAD = True
@@ -1,14 +1,45 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from .models import Job, OutboxEmail, Team, TeamJoinEvent, University, User
+
+
+class EstimatedCountPaginator(Paginator):
+    # Below this many rows an exact COUNT(*) is cheap enough
+    ESTIMATE_THRESHOLD = 10000
+
+    @cached_property
+    def count(self):
+        # An unfiltered COUNT(*) is a full table scan on PostgreSQL, so use the
+        # planner's estimate instead (searches and filters are counted exactly)
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql' and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples FROM pg_class WHERE relname = %s",
+                    [queryset.model._meta.db_table],
+                )
+                row = cursor.fetchone()
+            if row and row[0] > self.ESTIMATE_THRESHOLD:
+                return int(row[0])
+        return super().count
 
-from .models import Team, TeamJoinEvent, University, User
 
 @admin.register(University)
 class UniversityAdmin(admin.ModelAdmin):
-    list_display = ('name', 'students')
+    list_display = ('name', 'students', 'teams')
 
-    @admin.display(description="Number of students")
+    @admin.display(description="Number of students", ordering='student_count')
     def students(self, obj):
-        return User.objects.filter(university=obj).count()
+        return obj.student_count
+
+    @admin.display(description="Number of teams", ordering='team_count')
+    def teams(self, obj):
+        return obj.team_count
 
     search_fields = ('name', 'short_name')
 
@@ -17,7 +48,12 @@ class UniversityAdmin(admin.ModelAdmin):
 class UserAdmin(admin.ModelAdmin):
     list_display = ('full_name', 'university', 'team', 'is_verified', 'created_at')
 
-    list_filter = ('university',)
+    list_filter = ('university', ('credentials_sent_at', admin.EmptyFieldListFilter))
+
+    list_select_related = ('university', 'team')
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
     search_fields = (
         'codeforces_handle', 'email', 'first_name', 'github_handle',
@@ -25,6 +61,13 @@ class UserAdmin(admin.ModelAdmin):
         'university__name',
     )
 
+    def get_search_results(self, request, queryset, search_term):
+        # All the search_fields are denormalized into User.search_document,
+        # which on PostgreSQL is backed by a trigram index
+        for term in search_term.lower().split():
+            queryset = queryset.filter(search_document__contains=term)
+        return queryset, False
+
 
 @admin.register(Team)
 class TeamAdmin(admin.ModelAdmin):
@@ -32,11 +75,51 @@ class TeamAdmin(admin.ModelAdmin):
 
     list_filter = ('university',)
 
+    list_select_related = ('university',)
+
     search_fields = ('user__first_name', 'user__last_name')
 
-    @admin.display(description="Number of students")
+    @admin.display(description="Number of students", ordering='member_count')
     def students(self, obj):
-        return User.objects.filter(team=obj).count()
+        return obj.member_count
+
+
+@admin.register(TeamJoinEvent)
+class TeamJoinEventAdmin(admin.ModelAdmin):
+    list_select_related = ('user', 'team')
 
 
-admin.site.register(TeamJoinEvent)
+@admin.register(OutboxEmail)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'recipients', 'created_at', 'attempts', 'sent_at', 'failed')
+
+    list_filter = ('failed', ('sent_at', admin.EmptyFieldListFilter))
+
+    search_fields = ('subject', 'to')
+
+    readonly_fields = ('created_at', 'attempts', 'sent_at', 'last_error')
+
+    actions = ['send_again']
+
+    @admin.display(description="To")
+    def recipients(self, obj):
+        return ", ".join(obj.to)
+
+    @admin.action(description="Send again")
+    def send_again(self, request, queryset):
+        count = queryset.update(sent_at=None, failed=False, attempts=0, next_attempt_at=timezone.now())
+        self.message_user(request, f"{count} emails queued again.")
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'created_by', 'created_at', 'status', 'progress', 'duration')
+
+    list_filter = ('kind', 'status')
+
+    list_select_related = ('created_by',)
+
+    readonly_fields = (
+        'created_at', 'status', 'progress', 'total', 'started_at', 'finished_at', 'error',
+        'artifact', 'checksum', 'size', 'version',
+    )
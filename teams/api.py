@@ -0,0 +1,191 @@
+"""
+Read-only JSON API.
+
+Every list is paginated by id: the response has the `results` and the URL of
+the `next` page (null on the last one). `?limit=` sets the page size and
+`?fields=name,team_count` selects the fields of each result. Responses carry
+an ETag derived from the data version of the universities they show, so
+polling with If-None-Match costs a single query while nothing changes.
+"""
+
+import base64
+from functools import wraps
+
+from django.db.models import Prefetch
+from django.http import JsonResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from django.views.decorators.http import require_GET
+
+from teams.models import MAX_TEAM_MEMBERS, MEMBER_COLUMNS, Team, University, User, data_version, university_data_version
+from teams.pagecache import add_validators, page_query, version_tag
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Query parameters read by the views, the others don't change the response
+API_PARAMS = ['limit', 'cursor', 'fields', 'university']
+
+UNIVERSITY_FIELDS = {
+    'short_name': lambda u: u.short_name,
+    'name': lambda u: u.name,
+    'team_count': lambda u: u.team_count,
+    'student_count': lambda u: u.student_count,
+    'flag': lambda u: u.flag_300,
+}
+
+MEMBER_FIELDS = {
+    'name': lambda s: s.full_name,
+    'is_verified': lambda s: s.is_verified,
+    'is_staff': lambda s: s.is_staff,
+    'is_swerc_eligible': lambda s: s.is_swerc_eligible,
+    'kattis_handle': lambda s: s.kattis_handle,
+    'olinfo_handle': lambda s: s.olinfo_handle,
+    'codeforces_handle': lambda s: s.codeforces_handle,
+    'github_handle': lambda s: s.github_handle,
+}
+
+TEAM_FIELDS = {
+    'id': lambda t: t.id,
+    'name': lambda t: t.name,
+    'member_count': lambda t: t.member_count,
+    'free_slots': lambda t: MAX_TEAM_MEMBERS - t.member_count,
+    'members': lambda t: [{field: get(s) for field, get in MEMBER_FIELDS.items()} for s in t.user_set.all()],
+}
+
+OPEN_TEAM_FIELDS = {
+    'id': lambda t: t.id,
+    'name': lambda t: t.name,
+    'university': lambda t: t.university.short_name if t.university else None,
+    'member_count': lambda t: t.member_count,
+    'free_slots': lambda t: MAX_TEAM_MEMBERS - t.member_count,
+}
+
+
+class BadRequest(Exception):
+    pass
+
+
+def _json(data, status=200):
+    # Compact, these are meant to be polled
+    return JsonResponse(data, status=status, json_dumps_params={'separators': (',', ':')})
+
+
+def _page_params(request):
+    try:
+        limit = int(request.GET.get('limit', PAGE_SIZE))
+    except ValueError:
+        raise BadRequest("limit must be a number")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise BadRequest(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+
+    after = 0
+    if 'cursor' in request.GET:
+        try:
+            after = int(base64.urlsafe_b64decode(request.GET['cursor'].encode()))
+        except ValueError:
+            raise BadRequest("Invalid cursor")
+    return limit, after
+
+
+def _selected_fields(request, fields):
+    if 'fields' not in request.GET:
+        return fields
+    selected = {}
+    for name in request.GET['fields'].split(','):
+        if name not in fields:
+            raise BadRequest(f"Unknown field {name!r}, choose from {', '.join(fields)}")
+        selected[name] = fields[name]
+    return selected
+
+
+def _paginated(request, queryset, fields, key='id'):
+    """
+    One page of `queryset` (ordered by `key`, an increasing unique integer).
+    """
+    limit, after = _page_params(request)
+    fields = _selected_fields(request, fields)
+
+    rows = list(queryset.filter(**{f'{key}__gt': after}).order_by(key)[:limit + 1])
+    next_url = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        query = page_query(request, API_PARAMS)
+        query['cursor'] = base64.urlsafe_b64encode(str(getattr(rows[-1], key)).encode()).decode()
+        next_url = f"{request.path}?{query.urlencode()}"
+
+    return _json({
+        'results': [{name: get(row) for name, get in fields.items()} for row in rows],
+        'next': next_url,
+    })
+
+
+def versioned(version_func):
+    """
+    Answer with 304 if the data version (see `version_func`, which gets the
+    request and the arguments of the view) didn't change since the client got
+    the same page.
+    """
+    def decorator(view):
+        @require_GET
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            try:
+                version, changed_at = version_func(request, *args, **kwargs)
+                if version is None:
+                    response = view(request, *args, **kwargs)
+                else:
+                    etag = quote_etag(version_tag(request, version, changed_at, API_PARAMS))
+                    last_modified = int(changed_at.timestamp())
+                    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+                    if response is None:
+                        response = view(request, *args, **kwargs)
+                        if response.status_code == 200:
+                            add_validators(response, etag, last_modified)
+            except BadRequest as e:
+                response = _json({'error': str(e)}, status=400)
+
+            patch_cache_control(response, no_cache=True)
+            return response
+        return wrapper
+    return decorator
+
+
+def _not_found(message):
+    return _json({'error': message}, status=404)
+
+
+@versioned(lambda request: data_version())
+def universities(request):
+    return _paginated(request, University.objects.all(), UNIVERSITY_FIELDS)
+
+
+@versioned(lambda request, university_short_name: university_data_version(university_short_name))
+def university_teams(request, university_short_name):
+    university = University.objects.filter(short_name=university_short_name).first()
+    if university is None:
+        return _not_found("University not found")
+
+    teams = Team.objects.filter(university=university).only('name', 'member_count').prefetch_related(
+        Prefetch('user_set', queryset=User.objects.only(*MEMBER_COLUMNS).order_by('team', 'id')),
+    )
+    return _paginated(request, teams, TEAM_FIELDS)
+
+
+def _open_teams_version(request):
+    if 'university' in request.GET:
+        return university_data_version(request.GET['university'])
+    return data_version()
+
+
+@versioned(_open_teams_version)
+def open_teams(request):
+    teams = Team.objects.filter(member_count__lt=MAX_TEAM_MEMBERS).select_related('university').only(
+        'name', 'member_count', 'university__short_name',
+    )
+    if 'university' in request.GET:
+        university = University.objects.filter(short_name=request.GET['university']).first()
+        if university is None:
+            return _not_found("University not found")
+        teams = teams.filter(university=university)
+    return _paginated(request, teams, OPEN_TEAM_FIELDS)
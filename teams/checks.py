@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+CREDENTIALS_ENGINES = ('stored', 'hmac')
+
+# The value suggested in DEPLOY.md, which must be replaced
+PLACEHOLDER_SECRET = 'generate-a-new-secret-key-here'
+
+
+@register(Tags.security, deploy=True)
+def check_credentials_settings(app_configs, **kwargs):
+    # See teams/credentials.py
+    if settings.CREDENTIALS_ENGINE not in CREDENTIALS_ENGINES:
+        return [Error(
+            f"CREDENTIALS_ENGINE must be one of {', '.join(CREDENTIALS_ENGINES)}, not {settings.CREDENTIALS_ENGINE!r}.",
+            id='teams.E001',
+        )]
+    if settings.CREDENTIALS_ENGINE != 'hmac':
+        return []
+    if not settings.CREDENTIALS_SECRET:
+        return [Error(
+            "CREDENTIALS_SECRET must be set to derive the credentials.",
+            hint="Generate a long random secret, and keep it: another secret gives other passwords.",
+            id='teams.E002',
+        )]
+    if settings.CREDENTIALS_SECRET == PLACEHOLDER_SECRET:
+        return [Error(
+            "CREDENTIALS_SECRET is still the placeholder of DEPLOY.md, anyone could derive the passwords.",
+            hint="Generate a long random secret, and keep it: another secret gives other passwords.",
+            id='teams.E003',
+        )]
+    return []
@@ -0,0 +1,73 @@
+"""
+Contest (DOMjudge) credentials of the students.
+
+With CREDENTIALS_ENGINE = "stored" random passwords are generated on the
+first export and saved in User.credentials. With "hmac" they are derived
+from the user id and CREDENTIALS_SECRET: nothing is written, and the same
+secret always gives the same credentials. Stored credentials always take
+precedence, so the ones already handed out keep working after switching to
+"hmac" (and `manage.py store_credentials` saves the derived ones before
+switching back or changing the secret).
+"""
+
+import hashlib
+import hmac
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils.crypto import get_random_string
+
+from teams.models import User
+
+# 32 characters that can't be mistaken for one another, so that every
+# character of the password is exactly 5 bits of the HMAC
+PASSWORD_ALPHABET = 'abcdefghijkmnpqrstuvwxyz23456789'
+PASSWORD_LENGTH = 10
+
+BATCH_SIZE = 2000
+
+
+def username(user_id):
+    return f"itacpc-user-{user_id}"
+
+
+def derived_credentials(user_id):
+    if not settings.CREDENTIALS_SECRET:
+        raise ImproperlyConfigured("CREDENTIALS_SECRET must be set to derive the credentials.")
+    digest = hmac.new(settings.CREDENTIALS_SECRET.encode(), username(user_id).encode(), hashlib.sha256).digest()
+    return {
+        "username": username(user_id),
+        "password": "".join(PASSWORD_ALPHABET[b % len(PASSWORD_ALPHABET)] for b in digest[:PASSWORD_LENGTH]),
+    }
+
+
+def credentials_for(user):
+    """
+    Credentials of `user` (which needs only `id` and `credentials`), or None
+    if they were not generated yet.
+    """
+    if user.credentials:
+        return user.credentials
+    if settings.CREDENTIALS_ENGINE == 'hmac':
+        return derived_credentials(user.id)
+    return None
+
+
+def provision_credentials():
+    # Generate credentials only once per user (so that we can request
+    # accounts.json multiple times without getting different results)
+    if settings.CREDENTIALS_ENGINE == 'hmac':
+        return
+    with transaction.atomic():
+        users = list(
+            User.objects.select_for_update()
+            .filter(is_verified=True, credentials__isnull=True)
+            .only('id', 'credentials')
+        )
+        for user in users:
+            user.credentials = {
+                "username": username(user.id),
+                "password": get_random_string(8),
+            }
+        User.objects.bulk_update(users, ['credentials'], batch_size=BATCH_SIZE)
@@ -0,0 +1,254 @@
+"""
+Files exported for DOMjudge (and for mailing the credentials), generated by
+the `export` job (see teams/jobs.py) and downloaded from the export page.
+
+Every export is generated one item at a time from server-side cursors, so
+that memory use stays flat regardless of the number of users. The files are
+kept together with the version of the data they were generated from, and
+are generated again only when it changes.
+"""
+
+import csv
+import hashlib
+import io
+import json
+import os
+import textwrap
+import time
+
+from allauth.account.models import EmailAddress
+from django.conf import settings
+from django.db.models import Exists, OuterRef
+
+from teams import jobs, metrics
+from teams.credentials import credentials_for, provision_credentials
+from teams.models import Job, Team, University, User, data_version
+
+
+# Number of rows fetched at a time from the server-side cursor while exporting
+EXPORT_CHUNK_SIZE = 2000
+
+# Files of each export kept on disk, including the latest one
+EXPORTS_KEPT = 3
+
+# Approximate size of each chunk written to the file
+EXPORT_BUFFER_SIZE = 64 * 1024
+
+
+def _buffered(chunks):
+    # Group small strings together to avoid writing them one by one
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= EXPORT_BUFFER_SIZE:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def _json_chunks(items):
+    # Same output as json.dumps(list(items), indent=4), one item at a time
+    first = True
+    for item in items:
+        yield ("[\n" if first else ",\n") + textwrap.indent(json.dumps(item, indent=4), " " * 4)
+        first = False
+    yield "[]" if first else "\n]"
+
+
+def _csv_chunks(rows, fieldnames):
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=fieldnames, extrasaction='ignore')
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate()
+    yield output.getvalue()
+
+
+def export_groups():
+    return [{
+        "id": "1001",
+        "icpc_id": "1001",
+        "name": "ITACPC students",
+        "sortorder": 1,
+    }, {
+        "id": "1002",
+        "icpc_id": "1002",
+        "name": "ITACPC non-students",
+        "sortorder": 2,
+    }]
+
+
+def export_organizations():
+    has_students = Exists(User.objects.filter(university=OuterRef('pk')))
+    universities = University.objects.filter(has_students).order_by('id').values_list('short_name', 'name')
+
+    for short_name, name in universities:
+        yield {
+            "id": short_name,
+            "icpc_id": short_name,
+            "name": short_name,
+            "formal_name": name,
+            "country": "ITA",
+        }
+
+
+def export_teams():
+    teams = Team.objects.order_by('id').values_list('id', 'name', 'university__short_name')
+
+    for id, name, university_short_name in teams.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        team_id = f"itacpc-team-{id}"
+
+        yield {
+            "id": team_id,
+            "icpc_id": team_id,
+            "group_ids": ['1002' if university_short_name == 'other' else '1001'],
+            "name": name,
+            "organization_id": university_short_name,
+        }
+
+    # Create a fake team for the single users
+    single_users = User.objects.filter(team=None, is_verified=True).order_by('id').values_list(
+        'id', 'first_name', 'last_name', 'university__short_name',
+    )
+
+    for id, first_name, last_name, university_short_name in single_users.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        team_id = f"itacpc-single-{id}"
+
+        yield {
+            "id": team_id,
+            "icpc_id": team_id,
+            "group_ids": ['1002' if university_short_name == 'other' else '1001'],
+            "name": f"{first_name} {last_name}",
+            "organization_id": university_short_name,
+        }
+
+
+def export_accounts(with_team_name=False):
+    # Do all the writes (if any, see teams/credentials.py) and the email
+    # lookup upfront, so that the rows below can be streamed straight from a
+    # single read-only query
+    provision_credentials()
+
+    verified_emails = {}
+    for user_id, email in EmailAddress.objects.filter(verified=True).order_by('id').values_list('user_id', 'email'):
+        verified_emails.setdefault(user_id, []).append(email)
+
+    users = User.objects.filter(is_verified=True).select_related('team').order_by('id')
+
+    def rows():
+        for user in users.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+            user_id = f"itacpc-user-{user.id}"
+            credentials = credentials_for(user)
+
+            # Add all fields that are used by DOMJudge
+            obj = {
+                "id": user_id,
+                "username": credentials['username'],
+                "password": credentials['password'],
+                "email": ",".join(verified_emails.get(user.id, [])),
+                "type": "team",
+                "name": user.full_name,
+                "team_id": f"itacpc-team-{user.team.id}" if user.team else f"itacpc-single-{user.id}",
+            }
+
+            # Add fields that are used by Mailipy
+            if with_team_name:
+                obj["team_name"] = user.team.name if user.team else user.full_name
+
+            yield obj
+
+    return rows()
+
+
+ACCOUNTS_CSV_FIELDS = ['email', 'name', 'team_name', 'username', 'password']
+
+# Key of the export: name of the file and function generating its items
+EXPORTS = {
+    'groups': ('groups.json', export_groups),
+    'organizations': ('organizations.json', export_organizations),
+    'teams': ('teams.json', export_teams),
+    'accounts': ('accounts.json', export_accounts),
+    'accounts-csv': ('accounts.csv', lambda: export_accounts(with_team_name=True)),
+}
+
+
+def export_chunks(key, items=None):
+    """
+    Name and content (as an iterator of strings) of the export `key`.
+    `items` wraps the items before they are written, e.g. to count them.
+    """
+    filename, generate = EXPORTS[key]
+    generated = generate()
+    if items:
+        generated = items(generated)
+    if filename.endswith('.csv'):
+        return filename, _buffered(_csv_chunks(generated, ACCOUNTS_CSV_FIELDS))
+    return filename, _buffered(_json_chunks(generated))
+
+
+def export_versions():
+    """
+    Version of the data in every export: the exports are generated again
+    only when it changes.
+    """
+    version, _ = data_version()
+    # The same data gives other passwords with another engine or secret
+    engine = f"{settings.CREDENTIALS_ENGINE}:{settings.CREDENTIALS_SECRET}"
+    credentials_version = f"{version}-{hashlib.sha256(engine.encode()).hexdigest()[:12]}"
+    return {
+        key: credentials_version if key in ('accounts', 'accounts-csv') else version
+        for key in EXPORTS
+    }
+
+
+def current_export(key, version):
+    """
+    The latest export job of `key` that was generated from `version`, if its
+    file is still there.
+    """
+    job = Job.objects.filter(
+        kind='export', args={'key': key}, status=Job.Status.DONE, version=version,
+    ).exclude(artifact='').order_by('-id').first()
+    if job and os.path.exists(jobs.artifact_path(job.artifact)):
+        return job
+    return None
+
+
+def export_job(job, key):
+    start = time.perf_counter()
+    # Read before generating: if the data changes meanwhile, the export is
+    # generated again at the next request
+    job.version = export_versions()[key]
+    Job.objects.filter(pk=job.pk).update(version=job.version)
+
+    def counted(items):
+        count = 0
+        for item in items:
+            count += 1
+            jobs.report_progress(job, count)
+            yield item
+        jobs.report_progress(job, count, total=count)
+
+    filename, chunks = export_chunks(key, counted)
+    artifact = os.path.join('jobs', str(job.pk), filename)
+    path = jobs.artifact_path(artifact)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'w', encoding='utf-8', newline='') as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(f'{path}.tmp', path)
+
+    # Keep only the latest files of each export
+    previous = Job.objects.filter(kind='export', args={'key': key}, status=Job.Status.DONE).exclude(artifact='')
+    for old in previous.order_by('-id')[EXPORTS_KEPT - 1:]:
+        jobs.delete_artifact(old)
+
+    metrics.export_duration.observe(time.perf_counter() - start, key=key)
+    return artifact
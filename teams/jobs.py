@@ -0,0 +1,122 @@
+"""
+Background jobs, without a broker: every job is a row of the Job table, and
+`manage.py run_jobs` runs the queued ones in a pool of processes.
+
+A job is a function (see KINDS) that gets the Job, to report its progress,
+and the arguments it was enqueued with. It returns the path of the file it
+produced, relative to ARTIFACTS_DIR, or None; its SHA-256 checksum and size
+are stored with the job.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from teams.models import Job
+
+logger = logging.getLogger(__name__)
+
+KINDS = {
+    'export': 'teams.exports.export_job',
+}
+
+# Progress is written to the DB at most this often
+PROGRESS_INTERVAL = 1
+
+# A job still running after this long is considered lost, e.g. its worker was
+# killed before it could mark it as failed
+RUNNING_TIMEOUT = timedelta(minutes=30)
+
+
+def enqueue(kind, user=None, **args):
+    if kind not in KINDS:
+        raise ValueError(f"Unknown job {kind!r}")
+    return Job.objects.create(kind=kind, args=args, created_by=user)
+
+
+def pending(kind, **args):
+    """
+    The jobs of `kind` with these arguments that are queued or still running.
+    """
+    return Job.objects.filter(kind=kind, args=args).filter(
+        Q(status=Job.Status.QUEUED)
+        | Q(status=Job.Status.RUNNING, started_at__gt=timezone.now() - RUNNING_TIMEOUT)
+    )
+
+
+def expire():
+    """
+    Mark the jobs running for longer than RUNNING_TIMEOUT as failed, return
+    how many.
+    """
+    return Job.objects.filter(
+        status=Job.Status.RUNNING, started_at__lte=timezone.now() - RUNNING_TIMEOUT,
+    ).update(status=Job.Status.FAILED, error="The job did not finish in time.", finished_at=timezone.now())
+
+
+def artifact_path(artifact):
+    return os.path.join(settings.ARTIFACTS_DIR, artifact)
+
+
+def report_progress(job, progress, total=None):
+    now = time.monotonic()
+    if now - getattr(job, '_reported_at', 0) < PROGRESS_INTERVAL and progress != total:
+        return
+    job._reported_at = now
+    Job.objects.filter(pk=job.pk).update(progress=progress, total=total)
+
+
+def claim(limit):
+    """
+    Mark up to `limit` queued jobs as running, return their ids.
+    """
+    with transaction.atomic():
+        ids = list(
+            Job.objects.filter(status=Job.Status.QUEUED).select_for_update(skip_locked=True)
+            .order_by('created_at').values_list('id', flat=True)[:limit]
+        )
+        Job.objects.filter(pk__in=ids).update(status=Job.Status.RUNNING, started_at=timezone.now())
+    return ids
+
+
+def run(job_id):
+    # Only a job that is still running is finished: one that took too long
+    # was already marked as failed (see expire), and stays so
+    job = Job.objects.get(pk=job_id)
+    try:
+        artifact = import_string(KINDS[job.kind])(job, **job.args)
+    except Exception:
+        logger.exception("Job %s failed", job)
+        Job.objects.filter(pk=job_id, status=Job.Status.RUNNING).update(
+            status=Job.Status.FAILED, error=traceback.format_exc(), finished_at=timezone.now(),
+        )
+    else:
+        checksum, size = _file_digest(artifact_path(artifact)) if artifact else ('', None)
+        finished = Job.objects.filter(pk=job_id, status=Job.Status.RUNNING).update(
+            status=Job.Status.DONE, artifact=artifact or '', checksum=checksum, size=size, finished_at=timezone.now(),
+        )
+        if not finished and artifact:
+            logger.warning("Job %s finished after it expired, discarding %s", job, artifact)
+            job.artifact = artifact
+            delete_artifact(job)
+
+
+def _file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest(), os.fstat(f.fileno()).st_size
+
+
+def delete_artifact(job):
+    if job.artifact:
+        shutil.rmtree(os.path.dirname(artifact_path(job.artifact)), ignore_errors=True)
+        Job.objects.filter(pk=job.pk).update(artifact='')
@@ -0,0 +1,3 @@
+"""
+Load testing of the registration flows, see `manage.py loadtest --help`.
+"""
@@ -0,0 +1,63 @@
+import http.cookiejar
+import re
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+CSRF_TOKEN_RE = re.compile(r'name="csrfmiddlewaretoken" value="([^"]+)"')
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    # Redirects are recorded as such instead of being followed
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Session:
+    """
+    A browser-like HTTP client with its own cookies and client IP address
+    (sent as X-Forwarded-For, like nginx does, so that the per-IP rate limits
+    of allauth see each virtual user as a different person).
+    """
+
+    def __init__(self, base_url, stats, client_ip, timeout=60):
+        self.base_url = base_url.rstrip('/')
+        self.stats = stats
+        self.client_ip = client_ip
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            NoRedirect,
+        )
+
+    def get(self, route, path):
+        return self.request(route, path)
+
+    def post(self, route, path, data, page):
+        # Submit a form from a page that was previously fetched with get()
+        match = CSRF_TOKEN_RE.search(page)
+        if match:
+            data = {**data, 'csrfmiddlewaretoken': match.group(1)}
+        return self.request(route, path, data)
+
+    def request(self, route, path, data=None):
+        url = self.base_url + path
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        request = urllib.request.Request(url, data=body, headers={
+            'X-Forwarded-For': self.client_ip,
+            'Referer': url,
+        })
+
+        start = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=self.timeout) as response:
+                status, content = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, content = e.code, e.read()
+        except OSError:
+            # Connection refused/reset or timed out
+            status, content = 0, b''
+        self.stats.record(route, status, time.perf_counter() - start)
+
+        return status, content.decode('utf-8', errors='replace')
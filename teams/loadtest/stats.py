@@ -0,0 +1,47 @@
+import math
+import threading
+from collections import Counter, defaultdict
+
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return 0
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+
+    def record(self, route, status, seconds):
+        with self.lock:
+            self.latencies[route].append(seconds)
+            self.statuses[route][status] += 1
+
+    def summary(self, elapsed):
+        rows = []
+        with self.lock:
+            routes = sorted(self.latencies)
+            everything = []
+            for route in routes:
+                latencies = sorted(self.latencies[route])
+                everything += latencies
+                rows.append(self._row(route, latencies, self.statuses[route], elapsed))
+            total_statuses = sum(self.statuses.values(), Counter())
+            rows.append(self._row('TOTAL', sorted(everything), total_statuses, elapsed))
+        return rows
+
+    def _row(self, route, latencies, statuses, elapsed):
+        return {
+            "route": route,
+            "requests": len(latencies),
+            "errors": sum(n for status, n in statuses.items() if status == 0 or status >= 500),
+            "statuses": dict(sorted(statuses.items())),
+            "throughput": len(latencies) / elapsed if elapsed else 0,
+            "p50": percentile(latencies, 50) * 1000,
+            "p95": percentile(latencies, 95) * 1000,
+            "p99": percentile(latencies, 99) * 1000,
+        }
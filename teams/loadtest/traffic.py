@@ -0,0 +1,263 @@
+import random
+import re
+import threading
+import time
+import uuid
+
+from allauth.account.models import EmailAddress
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+
+from teams.loadtest.client import Session
+from teams.models import OutboxEmail, Team, User, bulk_changes, rebuild_counters
+
+# Relative weight of each action in the traffic mix
+DEFAULT_MIX = {
+    'index': 40,
+    'university': 30,
+    'signup': 5,
+    'create-team': 8,
+    'join-team': 8,
+    'leave-team': 8,
+    'export': 1,
+}
+
+EXPORT_KEYS = ['groups', 'organizations', 'teams', 'accounts', 'accounts-csv']
+
+# Every account and team created by the load test is recognizable by this prefix
+PREFIX = 'loadtest-'
+PASSWORD = 'loadtest-password'
+
+INVITATION_RE = re.compile(r'/join/([\w-]+)')
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(','):
+        action, weight = item.split('=')
+        if action not in DEFAULT_MIX:
+            raise ValueError(f"Unknown action {action!r}, choose from {', '.join(DEFAULT_MIX)}")
+        mix[action] = int(weight)
+    return mix
+
+
+def email_domain(university):
+    if university.domain == '*':
+        return 'example.org'
+    return university.domain.split(',')[0]
+
+
+def seed(num_users, universities):
+    """
+    Create `num_users` verified students spread over `universities`, plus a
+    superuser for the exports. All of them share the same password.
+    """
+    password = make_password(PASSWORD)
+    users = []
+    for i in range(num_users):
+        university = universities[i % len(universities)]
+        user = User(
+            email=f"{PREFIX}{uuid.uuid4().hex[:12]}@{email_domain(university)}",
+            first_name="Load",
+            last_name=f"Test {i}",
+            university=university,
+            is_verified=True,
+            password=password,
+        )
+        user.search_document = user.build_search_document()
+        users.append(user)
+
+    admin = User(
+        email=f"{PREFIX}admin-{uuid.uuid4().hex[:12]}@example.org",
+        first_name="Load",
+        last_name="Test admin",
+        university=universities[0],
+        is_verified=True,
+        is_staff=True,
+        is_superuser=True,
+        password=password,
+    )
+    admin.search_document = admin.build_search_document()
+
+    with transaction.atomic():
+        users = User.objects.bulk_create(users + [admin], batch_size=1000)
+        EmailAddress.objects.bulk_create([
+            EmailAddress(user=user, email=user.email, verified=True, primary=True)
+            for user in users
+        ], batch_size=1000)
+        rebuild_counters()
+
+    return users[:-1], users[-1]
+
+
+def cleanup():
+    with bulk_changes():
+        _, users = User.objects.filter(email__startswith=PREFIX).delete()
+        _, teams = Team.objects.filter(name__startswith=PREFIX).delete()
+    # The confirmation emails of the signups, to addresses of the real
+    # domains of the universities
+    emails, _ = OutboxEmail.objects.filter(to__icontains=f'"{PREFIX}').delete()
+    return users.get('teams.User', 0), teams.get('teams.Team', 0), emails
+
+
+class TeamPool:
+    """
+    Invitation secrets known to the virtual users, per university.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.secrets = {}
+
+    def add(self, university, secret):
+        with self.lock:
+            self.secrets.setdefault(university, set()).add(secret)
+
+    def discard(self, university, secret):
+        with self.lock:
+            self.secrets.get(university, set()).discard(secret)
+
+    def pick(self, university, rng):
+        with self.lock:
+            secrets = sorted(self.secrets.get(university, ()))
+        return rng.choice(secrets) if secrets else None
+
+
+class VirtualUser:
+    def __init__(self, base_url, stats, account, admin, universities, pool, mix, seed):
+        self.base_url = base_url
+        self.stats = stats
+        self.email = account.email
+        self.own_university = account.university
+        self.admin_email = admin.email
+        self.universities = universities
+        self.pool = pool
+        self.rng = random.Random(seed)
+        self.actions = list(mix)
+        self.weights = [mix[action] for action in self.actions]
+
+        self.session = self.new_session()
+        self.admin_session = None
+        self.team_secret = None
+        self.in_team = False
+
+    def new_session(self):
+        # A different (fake) client IP for every session
+        n = self.rng.randrange(1, 2 ** 24)
+        return Session(self.base_url, self.stats, f"10.{n >> 16}.{(n >> 8) & 255}.{n & 255}")
+
+    def login(self, session, email):
+        _, page = session.get('login', '/login/')
+        session.post('login', '/login/', {'login': email, 'password': PASSWORD}, page)
+
+    def step(self):
+        action = self.rng.choices(self.actions, self.weights)[0]
+
+        # Team actions depend on whether we are already in a team or not
+        if action in ('create-team', 'join-team') and self.in_team:
+            action = 'leave-team'
+        elif action == 'leave-team' and not self.in_team:
+            action = self.rng.choice(['create-team', 'join-team'])
+
+        getattr(self, action.replace('-', '_'))()
+
+    def index(self):
+        self.session.get('index', '/')
+
+    def university(self):
+        short_name = self.rng.choice(self.universities).short_name
+        self.session.get('university', f'/{short_name}')
+
+    def signup(self):
+        session = self.new_session()
+        university = self.rng.choice(self.universities)
+        path = f'/{university.short_name}/new-student'
+        _, page = session.get('signup', path)
+        session.post('signup', path, {
+            'first_name': "Load",
+            'last_name': "Test",
+            'email': f"{PREFIX}{uuid.uuid4().hex[:12]}@{email_domain(university)}",
+            'password1': PASSWORD,
+            'password2': PASSWORD,
+            'accept_terms': 'on',
+        }, page)
+
+    def create_team(self):
+        path = f'/{self.own_university.short_name}/new-team'
+        status, page = self.session.get('create-team', path)
+        if status != 200:
+            # Redirected away, e.g. because we are already in a team
+            self.in_team = True
+            return
+        status, page = self.session.post('create-team', path, {'name': f"{PREFIX}{uuid.uuid4().hex[:12]}"}, page)
+        match = INVITATION_RE.search(page)
+        if status == 200 and match:
+            self.team_secret = match.group(1)
+            self.pool.add(self.own_university.id, self.team_secret)
+            self.in_team = True
+
+    def join_team(self):
+        secret = self.pool.pick(self.own_university.id, self.rng)
+        if not secret:
+            return self.create_team()
+
+        status, page = self.session.get('join-team', f'/join/{secret}')
+        if status != 200:
+            self.pool.discard(self.own_university.id, secret)
+            return
+        self.session.post('join-team', f'/join/{secret}', {}, page)
+
+        # The outcome is only visible from the profile page
+        _, page = self.session.get('my-profile', '/my-profile')
+        if "You're part of team" in page:
+            self.team_secret = secret
+            self.in_team = True
+        elif "not part of any team" in page:
+            # Full team, or stale secret
+            self.pool.discard(self.own_university.id, secret)
+
+    def leave_team(self):
+        status, page = self.session.get('leave-team', '/leave-team')
+        if status == 200:
+            self.session.post('leave-team', '/leave-team', {}, page)
+
+        # Leaving rotates the secret of the team (or deletes it)
+        if self.team_secret:
+            self.pool.discard(self.own_university.id, self.team_secret)
+        self.team_secret = None
+        self.in_team = False
+
+    def export(self):
+        if not self.admin_session:
+            self.admin_session = self.new_session()
+            self.login(self.admin_session, self.admin_email)
+
+        _, page = self.admin_session.get('export', '/export')
+        self.admin_session.post('export', '/export', {'key': self.rng.choice(EXPORT_KEYS)}, page)
+
+    def run(self, deadline, think_time):
+        self.login(self.session, self.email)
+        while time.monotonic() < deadline:
+            self.step()
+            if think_time:
+                time.sleep(self.rng.uniform(0, 2 * think_time))
+
+
+def run(base_url, stats, accounts, admin, universities, concurrency, duration, ramp_up, think_time, mix, seed):
+    pool = TeamPool()
+    deadline = time.monotonic() + ramp_up + duration
+
+    virtual_users = [
+        VirtualUser(base_url, stats, accounts[i % len(accounts)], admin, universities, pool, mix, seed + i)
+        for i in range(concurrency)
+    ]
+    threads = []
+    for i, virtual_user in enumerate(virtual_users):
+        thread = threading.Thread(target=virtual_user.run, args=(deadline, think_time), daemon=True)
+        thread.start()
+        threads.append(thread)
+        if ramp_up:
+            time.sleep(ramp_up / concurrency)
+
+    for thread in threads:
+        thread.join()
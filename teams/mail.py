@@ -0,0 +1,147 @@
+"""
+Outgoing emails go through the DB.
+
+OutboxEmailBackend (the EMAIL_BACKEND in production) only stores the messages,
+in the same transaction as the request that sends them, so a signup doesn't
+wait for the email provider. `manage.py send_outbox` delivers them through
+OUTBOX_EMAIL_BACKEND.
+"""
+
+import base64
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.mail import EmailMessage, EmailMultiAlternatives, get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+
+from teams.models import OutboxEmail
+
+
+def to_outbox(message):
+    attachments = []
+    for attachment in message.attachments:
+        if not isinstance(attachment, tuple):
+            raise ValueError("Only (filename, content, mimetype) attachments can be queued")
+        filename, content, mimetype = attachment
+        if isinstance(content, str):
+            content = content.encode()
+        attachments.append([filename, base64.b64encode(content).decode(), mimetype])
+
+    return OutboxEmail(
+        subject=message.subject,
+        body=message.body,
+        from_email=message.from_email,
+        to=list(message.to),
+        cc=list(message.cc),
+        bcc=list(message.bcc),
+        reply_to=list(message.reply_to),
+        headers=dict(message.extra_headers),
+        alternatives=[list(alternative) for alternative in getattr(message, 'alternatives', [])],
+        attachments=attachments,
+    )
+
+
+def from_outbox(email, connection=None):
+    message = EmailMultiAlternatives if email.alternatives else EmailMessage
+    message = message(
+        subject=email.subject,
+        body=email.body,
+        from_email=email.from_email,
+        to=email.to,
+        cc=email.cc,
+        bcc=email.bcc,
+        reply_to=email.reply_to,
+        headers=email.headers,
+        connection=connection,
+    )
+    for content, mimetype in email.alternatives:
+        message.attach_alternative(content, mimetype)
+    for filename, content, mimetype in email.attachments:
+        message.attach(filename, base64.b64decode(content), mimetype)
+    return message
+
+
+class OutboxEmailBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        emails = [to_outbox(message) for message in email_messages if message.recipients()]
+        OutboxEmail.objects.bulk_create(emails)
+        return len(emails)
+
+
+class RateLimiter:
+    """
+    Lets through at most `rate` calls of wait() per second, across threads
+    (any number if `rate` is 0).
+    """
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+
+class MailPool:
+    """
+    Sends messages over `threads` connections of `backend` in parallel, every
+    connection kept open across messages, at most `rate` messages per second.
+    """
+    def __init__(self, backend=None, threads=4, rate=0):
+        self.backend = backend
+        self.limiter = RateLimiter(rate)
+        self.executor = ThreadPoolExecutor(threads)
+        self.local = threading.local()
+        self.connections = set()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = get_connection(self.backend, fail_silently=False)
+            connection.open()
+            self.local.connection = connection
+            with self.lock:
+                self.connections.add(connection)
+        return connection
+
+    def _send(self, message):
+        self.limiter.wait()
+        connection = self._connection()
+        try:
+            if not connection.send_messages([message]):
+                raise RuntimeError("The backend did not send the message")
+        except Exception:
+            # The connection might be broken, the next message opens a new one
+            self.local.connection = None
+            with self.lock:
+                self.connections.discard(connection)
+            connection.close()
+            raise
+
+    def send(self, messages):
+        """
+        Send the messages, return the exception raised by each of them (None
+        for the ones that were sent).
+        """
+        futures = [self.executor.submit(self._send, message) for message in messages]
+        return [future.exception() for future in futures]
+
+    def close(self):
+        self.executor.shutdown()
+        for connection in self.connections:
+            connection.close()
+        self.connections.clear()
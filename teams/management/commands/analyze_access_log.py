@@ -0,0 +1,192 @@
+import glob
+import gzip
+import heapq
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from datetime import datetime
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import Resolver404, resolve
+
+# Default gunicorn format, plus the request time in microseconds (%(D)s) that
+# gunicorn.conf.py appends at the end of the line
+LINE_RE = re.compile(
+    r'\S* \S+ \S+ \[(?P<time>[^\]]+)\] "(?P<method>\S+) (?P<path>\S+)[^"]*" (?P<status>\d{3}) \S+'
+    r'(?: "(?:[^"\\]|\\.)*" "(?:[^"\\]|\\.)*")?(?: (?P<duration>\d+))?\s*$'
+)
+
+# Latencies are counted in buckets that are 2% wide, so the percentiles are
+# within 2% of the exact ones whatever the number of requests
+BUCKET_GROWTH = 1.02
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.max = 0
+
+    def add(self, ms):
+        self.buckets[self._bucket(ms)] += 1
+        self.count += 1
+        self.max = max(self.max, ms)
+
+    def _bucket(self, ms):
+        return 0 if ms < 1 else int(math.log(ms, BUCKET_GROWTH)) + 1
+
+    def percentile(self, p):
+        if not self.count:
+            return 0
+        rank = max(1, math.ceil(p / 100 * self.count))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                # Upper bound of the bucket, but never above the slowest request
+                return min(self.max, BUCKET_GROWTH ** bucket if bucket else 1)
+        return self.max
+
+
+class RouteStats:
+    def __init__(self):
+        self.statuses = Counter()
+        self.latencies = Histogram()
+
+    def add(self, status, ms):
+        self.statuses[status // 100] += 1
+        if ms is not None:
+            self.latencies.add(ms)
+
+
+@lru_cache(maxsize=10000)
+def route_of(path):
+    try:
+        match = resolve(path)
+    except Resolver404:
+        return '<not found>'
+    return '/' + match.route
+
+
+def parse_window(value):
+    match = re.fullmatch(r'(\d+)([smhd])', value)
+    if not match:
+        raise ValueError("Use a number followed by s, m, h or d (e.g. 15m)")
+    return int(match.group(1)) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group(2)]
+
+
+class Command(BaseCommand):
+    help = """
+        Aggregate gunicorn access logs (plain or gzipped) per route of
+        teams/urls.py: requests, status codes and latency percentiles, over
+        the whole logs, per time window (--window) or as a list of the
+        slowest requests (--top). Memory use does not depend on the size of
+        the logs.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*', help="Log files, in chronological order (default: gunicorn.access.log and its rotations)")
+        parser.add_argument('--window', type=parse_window, help="Report every time window separately, e.g. 5m or 1h")
+        parser.add_argument('--top', type=int, help="List the N slowest requests instead")
+        parser.add_argument('--route', help="Only consider this route, e.g. /join/<secret>")
+
+    def handle(self, *args, **options):
+        files = options['files'] or self.default_files()
+        if not files:
+            raise CommandError("No access log found, pass the files to analyze.")
+
+        window = options['window']
+        top = options['top']
+        windows = defaultdict(lambda: defaultdict(RouteStats))
+        slowest = []
+        skipped = 0
+        without_duration = 0
+        timestamps = {}
+
+        for line in self.lines(files):
+            match = LINE_RE.match(line)
+            if not match:
+                skipped += 1
+                continue
+
+            route = route_of(match['path'].split('?', 1)[0])
+            if options['route'] and route != options['route']:
+                continue
+            status = int(match['status'])
+            ms = int(match['duration']) / 1000 if match['duration'] else None
+            if ms is None:
+                without_duration += 1
+
+            start = None
+            if window:
+                # Many requests share the same second, don't parse it every time
+                if match['time'] not in timestamps:
+                    if len(timestamps) > 1000:
+                        timestamps.clear()
+                    timestamps[match['time']] = datetime.strptime(match['time'], '%d/%b/%Y:%H:%M:%S %z')
+                time = timestamps[match['time']]
+                start = datetime.fromtimestamp(time.timestamp() // window * window, time.tzinfo)
+
+            if top:
+                if ms is not None:
+                    item = (ms, match['time'], match['method'], match['path'], status)
+                    if len(slowest) < top:
+                        heapq.heappush(slowest, item)
+                    else:
+                        heapq.heappushpop(slowest, item)
+            else:
+                windows[start][route].add(status, ms)
+
+        if top:
+            self.print_slowest(sorted(slowest, reverse=True))
+        else:
+            for start in sorted(windows, key=lambda start: start or datetime.min):
+                self.print_window(start, window, windows[start])
+
+        if skipped:
+            self.stderr.write(f"Skipped {skipped} lines in an unknown format.")
+        if without_duration:
+            self.stderr.write(
+                f"{without_duration} requests have no response time, they were logged "
+                "before %(D)s was added to access_log_format."
+            )
+
+    def default_files(self):
+        # Rotations (access.log.1, access.log.2.gz, ...) are older than the current log
+        paths = glob.glob(str(settings.BASE_DIR / 'gunicorn.access.log*'))
+        return sorted(paths, key=os.path.getmtime)
+
+    def lines(self, files):
+        for path in files:
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, 'rt', encoding='utf-8', errors='replace') as f:
+                yield from f
+
+    def print_window(self, start, window, routes):
+        self.stdout.write("")
+        if start:
+            self.stdout.write(f"{start:%Y-%m-%d %H:%M:%S} + {window}s")
+        self.stdout.write(
+            f"{'route':<40}{'requests':>10}{'2xx':>8}{'3xx':>8}{'4xx':>8}{'5xx':>8}"
+            f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+        )
+        for route, stats in sorted(routes.items(), key=lambda item: -sum(item[1].statuses.values())):
+            latencies = stats.latencies
+            if latencies.count:
+                timings = [latencies.percentile(p) for p in (50, 95, 99)] + [latencies.max]
+                timings = "".join(f"{ms:>9.0f}" for ms in timings)
+            else:
+                timings = "".join(f"{'-':>9}" for _ in range(4))
+            self.stdout.write(
+                f"{route:<40}{sum(stats.statuses.values()):>10}"
+                + "".join(f"{stats.statuses[n]:>8}" for n in (2, 3, 4, 5))
+                + timings
+            )
+
+    def print_slowest(self, slowest):
+        self.stdout.write(f"{'ms':>9}  {'time':<28}{'status':<8}request")
+        for ms, time, method, path, status in slowest:
+            self.stdout.write(f"{ms:>9.0f}  {time:<28}{status:<8}{method} {path}")
@@ -0,0 +1,217 @@
+import random
+import string
+import time
+
+from allauth.account.models import EmailAddress
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection
+from django.db.models import Max
+from django.utils import timezone
+
+from teams.models import MAX_TEAM_MEMBERS, Team, TeamJoinEvent, University, User, bulk_changes
+
+# Every account and team generated by this command is recognizable by this prefix
+PREFIX = 'generated-'
+
+FIRST_NAMES = [
+    "Alessandro", "Alice", "Andrea", "Anna", "Chiara", "Davide", "Elena",
+    "Federico", "Francesca", "Francesco", "Giorgia", "Giovanni", "Giulia",
+    "Lorenzo", "Luca", "Marco", "Martina", "Matteo", "Sara", "Simone",
+]
+LAST_NAMES = [
+    "Bianchi", "Bruno", "Colombo", "Conti", "Costa", "De Luca", "Esposito",
+    "Ferrari", "Gallo", "Greco", "Lombardi", "Mancini", "Marino", "Moretti",
+    "Ricci", "Romano", "Rossi", "Russo", "Fontana", "Barbieri",
+]
+
+
+class Command(BaseCommand):
+    help = """
+        Generate a large synthetic edition (students, teams, emails and
+        join/leave history) spread over the existing universities, to
+        benchmark the site on production-sized data. The rows are inserted
+        with explicit ids, don't run it while the site takes registrations.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000, help="Number of students to generate")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed (the same seed generates the same data)")
+        parser.add_argument('--unverified', type=float, default=0.1, help="Fraction of students who never confirm their email")
+        parser.add_argument('--individual', type=float, default=0.2, help="Fraction of verified students not in a team")
+        parser.add_argument('--churn', type=float, default=0.15, help="Fraction of team members who left another team before")
+        parser.add_argument('--password', help="Password of all the generated students (default: unusable)")
+        parser.add_argument('--chunk-size', type=int, default=5000, help="Number of students inserted at a time")
+        parser.add_argument('--delete', action='store_true', help="Delete the previously generated data and exit")
+
+    def handle(self, *args, **options):
+        if options['delete']:
+            with bulk_changes():
+                _, users = User.objects.filter(email__startswith=PREFIX).delete()
+                _, teams = Team.objects.filter(name__startswith=PREFIX).delete()
+            self.stdout.write(f"Deleted {users.get('teams.User', 0)} students and {teams.get('teams.Team', 0)} teams.")
+            return
+
+        # In a fixed order, so that the same seed generates the same data
+        universities = list(University.objects.filter(active=True).order_by('id'))
+        if not universities:
+            raise CommandError("No universities found, run `manage.py loaddata universities` first.")
+
+        seed = options['seed']
+        if User.objects.filter(email__startswith=f"{PREFIX}{seed}-").exists():
+            raise CommandError(f"Data with seed {seed} was already generated, use another --seed or --delete it first.")
+
+        self.rng = random.Random(seed)
+        self.options = options
+        self.password = make_password(options['password'])
+
+        # A few big universities and a long tail of small ones
+        weights = [1 / (rank + 1) for rank in range(len(universities))]
+        self.rng.shuffle(universities)
+
+        start = time.monotonic()
+        totals = {'users': 0, 'teams': 0, 'events': 0}
+        with bulk_changes():
+            self.last_ids = {
+                model: model.objects.aggregate(last=Max('id'))['last'] or 0
+                for model in (Team, User, EmailAddress, TeamJoinEvent)
+            }
+            generated = 0
+            while generated < options['users']:
+                size = min(options['chunk_size'], options['users'] - generated)
+                chunk_universities = self.rng.choices(universities, weights, k=size)
+                counts = self.generate_chunk(generated, chunk_universities)
+                for key in totals:
+                    totals[key] += counts[key]
+                generated += size
+                self.stdout.write(f"{generated}/{options['users']} students...")
+
+            # Move the sequences past the explicit ids
+            with connection.cursor() as cursor:
+                for sql in connection.ops.sequence_reset_sql(no_style(), list(self.last_ids)):
+                    cursor.execute(sql)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {totals['users']} students, {totals['teams']} teams and "
+            f"{totals['events']} join/leave events in {time.monotonic() - start:.1f}s."
+        ))
+
+    def next_id(self, model):
+        self.last_ids[model] += 1
+        return self.last_ids[model]
+
+    def insert(self, model, rows):
+        """
+        Insert `rows`, dicts of the values of the same columns (ready for the
+        database), the other columns get their default. Much faster than
+        bulk_create, which builds and prepares a model instance for every row.
+        """
+        if not rows:
+            return
+        defaults = {}
+        for field in model._meta.concrete_fields:
+            if field.column not in rows[0]:
+                value = timezone.now() if getattr(field, 'auto_now_add', False) else field.get_default()
+                defaults[field.column] = field.get_db_prep_save(value, connection)
+
+        quote = connection.ops.quote_name
+        table = quote(model._meta.db_table)
+        columns = ', '.join(quote(column) for column in [*rows[0], *defaults])
+        values = [(*row.values(), *defaults.values()) for row in rows]
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # COPY is the bulk load of PostgreSQL, several times faster
+                # than the INSERTs
+                with cursor.cursor.copy(f"COPY {table} ({columns}) FROM STDIN") as copy:
+                    for row in values:
+                        copy.write_row(row)
+            else:
+                placeholders = ', '.join(['%s'] * len(values[0]))
+                cursor.executemany(f"INSERT INTO {table} ({columns}) VALUES ({placeholders})", values)
+
+    def generate_chunk(self, offset, chunk_universities):
+        rng = self.rng
+        seed = self.options['seed']
+
+        users = []
+        for i, university in enumerate(chunk_universities):
+            domain = 'example.org' if university.domain == '*' else university.domain.split(',')[0]
+            first_name = rng.choice(FIRST_NAMES)
+            last_name = rng.choice(LAST_NAMES)
+            users.append({
+                'id': self.next_id(User),
+                'email': f"{PREFIX}{seed}-{offset + i}@{domain}",
+                'first_name': first_name,
+                'last_name': last_name,
+                'university_id': university.id,
+                'team_id': None,
+                'password': self.password,
+                'is_verified': rng.random() >= self.options['unverified'],
+                'is_swerc_eligible': rng.random() < 0.4,
+                'subscribed': rng.random() < 0.9,
+                'codeforces_handle': f"{first_name.lower()}{offset + i}" if rng.random() < 0.3 else None,
+                'github_handle': f"{last_name.lower().replace(' ', '')}{offset + i}" if rng.random() < 0.2 else None,
+            })
+
+        # Group the verified students of each university in teams of 1-3
+        by_university = {}
+        for user in users:
+            if user['is_verified'] and rng.random() >= self.options['individual']:
+                by_university.setdefault(user['university_id'], []).append(user)
+
+        teams = []
+        for university_id, members in by_university.items():
+            while members:
+                size = min(len(members), rng.choices([1, 2, MAX_TEAM_MEMBERS], [15, 25, 60])[0])
+                team = {
+                    'id': self.next_id(Team),
+                    'name': f"{PREFIX}{seed}-{offset}-{len(teams)}",
+                    'university_id': university_id,
+                    'secret': ''.join(rng.choices(string.ascii_letters + string.digits, k=16)),
+                    'member_count': size,
+                }
+                teams.append(team)
+                for _ in range(size):
+                    members.pop()['team_id'] = team['id']
+        self.insert(Team, teams)
+
+        # Like User.build_search_document
+        university_names = {university.id: university.name for university in chunk_universities}
+        team_names = {team['id']: team['name'] for team in teams}
+        for user in users:
+            values = [
+                user['codeforces_handle'], user['email'], user['first_name'], user['github_handle'],
+                user['last_name'], team_names.get(user['team_id']), university_names[user['university_id']],
+            ]
+            user['search_document'] = "\n".join(v for v in values if v).lower()
+        self.insert(User, users)
+
+        emails = []
+        for i, user in enumerate(users):
+            emails.append({'id': self.next_id(EmailAddress), 'user_id': user['id'], 'email': user['email'], 'verified': user['is_verified'], 'primary': True})
+            if user['is_verified'] and rng.random() < 0.1:
+                # Personal address added to receive the credentials
+                emails.append({
+                    'id': self.next_id(EmailAddress), 'user_id': user['id'],
+                    'email': f"{PREFIX}{seed}-{offset + i}@personal.example.org", 'verified': True, 'primary': False,
+                })
+        self.insert(EmailAddress, emails)
+
+        # Join/leave history: some members were in another team before
+        events = []
+        teams_by_university = {}
+        for team in teams:
+            teams_by_university.setdefault(team['university_id'], []).append(team['id'])
+        for user in users:
+            if not user['team_id']:
+                continue
+            if rng.random() < self.options['churn']:
+                previous = rng.choice(teams_by_university[user['university_id']])
+                if previous != user['team_id']:
+                    events.append({'id': self.next_id(TeamJoinEvent), 'user_id': user['id'], 'team_id': previous, 'joining': True})
+                    events.append({'id': self.next_id(TeamJoinEvent), 'user_id': user['id'], 'team_id': previous, 'joining': False})
+            events.append({'id': self.next_id(TeamJoinEvent), 'user_id': user['id'], 'team_id': user['team_id'], 'joining': True})
+        self.insert(TeamJoinEvent, events)
+
+        return {'users': len(users), 'teams': len(teams), 'events': len(events)}
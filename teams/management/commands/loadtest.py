@@ -0,0 +1,137 @@
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from teams.loadtest import traffic
+from teams.loadtest.stats import Stats
+from teams.models import University
+
+
+class Command(BaseCommand):
+    help = """
+        Simulate the rush at the opening of the registrations: seed some
+        students, then drive a mix of page views, signups, team changes and
+        exports against a local server and report latency percentiles and
+        throughput per route.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help="Base URL of an already running server (default: start gunicorn locally)")
+        parser.add_argument('--workers', type=int, help="Gunicorn workers to start (default: as in gunicorn.conf.py)")
+        parser.add_argument('--concurrency', type=int, default=20, help="Number of simultaneous virtual users")
+        parser.add_argument('--duration', type=float, default=60, help="Seconds of full load, after the ramp-up")
+        parser.add_argument('--ramp-up', type=float, default=5, help="Seconds over which the virtual users are started")
+        parser.add_argument('--think-time', type=float, default=0.5, help="Average pause between two actions of a virtual user")
+        parser.add_argument('--users', type=int, default=200, help="Number of students to seed")
+        parser.add_argument('--universities', type=int, default=5, help="Number of universities the seeded students belong to")
+        parser.add_argument('--mix', type=traffic.parse_mix, default=traffic.DEFAULT_MIX,
+                            help="Traffic mix as comma separated action=weight pairs (default: %s)" %
+                            ",".join(f"{k}={v}" for k, v in traffic.DEFAULT_MIX.items()))
+        parser.add_argument('--seed', type=int, default=0, help="Random seed")
+        parser.add_argument('--json', help="Also write the results to this file, to compare runs")
+        parser.add_argument('--keep', action='store_true', help="Don't delete the accounts and teams created by the test")
+        parser.add_argument('--cleanup', action='store_true', help="Only delete the leftovers of previous runs")
+
+    def handle(self, *args, **options):
+        if options['cleanup']:
+            num_users, num_teams, num_emails = traffic.cleanup()
+            self.stdout.write(f"Deleted {num_users} students, {num_teams} teams and {num_emails} emails.")
+            return
+
+        if settings.REGISTRATION_IS_CLOSED:
+            raise CommandError("Registrations are closed, most of the traffic would be rejected.")
+
+        rng = random.Random(options['seed'])
+        universities = list(University.objects.filter(active=True).exclude(short_name='other'))
+        if not universities:
+            raise CommandError("No universities found, run `manage.py loaddata universities` first.")
+        universities = rng.sample(universities, min(options['universities'], len(universities)))
+
+        num_users = max(options['users'], options['concurrency'])
+        self.stdout.write(f"Seeding {num_users} students...")
+        accounts, admin = traffic.seed(num_users, universities)
+
+        server = None
+        try:
+            base_url = options['url']
+            if not base_url:
+                server, base_url = self.start_server(options['workers'])
+
+            self.stdout.write(
+                f"Running {options['concurrency']} virtual users against {base_url} for "
+                f"{options['ramp_up'] + options['duration']:.0f}s..."
+            )
+            stats = Stats()
+            start = time.monotonic()
+            traffic.run(
+                base_url, stats, accounts, admin, universities,
+                concurrency=options['concurrency'],
+                duration=options['duration'],
+                ramp_up=options['ramp_up'],
+                think_time=options['think_time'],
+                mix=options['mix'],
+                seed=options['seed'],
+            )
+            summary = stats.summary(time.monotonic() - start)
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+            if not options['keep']:
+                traffic.cleanup()
+
+        self.print_summary(summary)
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump({"options": {k: options[k] for k in ('concurrency', 'duration', 'think_time', 'mix', 'seed')},
+                           "routes": summary}, f, indent=4)
+
+    def start_server(self, workers):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+
+        logs = tempfile.mkdtemp(prefix='itacpc-loadtest-')
+        command = [
+            sys.executable, '-m', 'gunicorn', 'itacpc.wsgi',
+            '--config', str(settings.BASE_DIR / 'gunicorn.conf.py'),
+            '--bind', f'127.0.0.1:{port}',
+            '--access-logfile', os.path.join(logs, 'access.log'),
+            '--error-logfile', os.path.join(logs, 'error.log'),
+        ]
+        if workers:
+            command += ['--workers', str(workers)]
+        server = subprocess.Popen(command, cwd=settings.BASE_DIR)
+
+        base_url = f'http://127.0.0.1:{port}'
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(base_url + '/', timeout=1)
+                self.stdout.write(f"Started gunicorn on {base_url} (logs in {logs})")
+                return server, base_url
+            except OSError:
+                if server.poll() is not None:
+                    break
+                time.sleep(0.2)
+
+        server.terminate()
+        raise CommandError(f"Could not start gunicorn, see the logs in {logs}")
+
+    def print_summary(self, summary):
+        self.stdout.write("")
+        self.stdout.write(f"{'route':<14}{'requests':>10}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}  statuses")
+        for row in summary:
+            statuses = " ".join(f"{status}:{n}" for status, n in row['statuses'].items())
+            self.stdout.write(
+                f"{row['route']:<14}{row['requests']:>10}{row['errors']:>8}{row['throughput']:>9.1f}"
+                f"{row['p50']:>9.1f}{row['p95']:>9.1f}{row['p99']:>9.1f}  {statuses}"
+            )
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from teams.models import rebuild_counters
+
+
+class Command(BaseCommand):
+    help = "Recompute the denormalized team/student counters from scratch"
+
+    def handle(self, *args, **options):
+        rebuild_counters()
+
+        self.stdout.write(self.style.SUCCESS("Counters rebuilt."))
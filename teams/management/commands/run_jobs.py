@@ -0,0 +1,89 @@
+import multiprocessing
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.utils import timezone
+
+from teams import jobs
+from teams.models import Job
+
+
+def ignore_signals():
+    # A stopping worker waits for the running jobs to finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def run_job(job_id):
+    try:
+        jobs.run(job_id)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = """
+        Run the queued background jobs (see teams/jobs.py) in a pool of
+        processes, until SIGTERM or, with --once, until there are no queued
+        jobs left. Only one worker must run at a time: when it starts, the
+        jobs left running by the previous one are marked as failed, and so
+        are the ones running for longer than jobs.RUNNING_TIMEOUT.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int,
+                            help="Jobs run in parallel (default: 2, 1 on SQLite, where they would lock each other out)")
+        parser.add_argument('--poll-interval', type=float, default=1, help="Seconds between checks for new jobs")
+        parser.add_argument('--once', action='store_true', help="Exit when there are no queued jobs left")
+
+    def handle(self, *args, **options):
+        processes = options['processes'] or (1 if connection.vendor == 'sqlite' else 2)
+
+        interrupted = Job.objects.filter(status=Job.Status.RUNNING).update(
+            status=Job.Status.FAILED, error="The worker was stopped while running the job.", finished_at=timezone.now(),
+        )
+        if interrupted:
+            self.stderr.write(f"Marked {interrupted} interrupted jobs as failed.")
+
+        stopping = threading.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            # Wait for the running jobs, then exit
+            signal.signal(signum, lambda signum, frame: stopping.set())
+
+        running = set()
+        # The processes are forked from this one, without its DB connections
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(processes, mp_context=context, initializer=ignore_signals) as pool:
+            while not stopping.is_set():
+                running = {future for future in running if not future.done()}
+                ids = []
+                if len(running) < processes:
+                    expired = jobs.expire()
+                    if expired:
+                        self.stderr.write(f"Marked {expired} jobs running for too long as failed.")
+                    ids = jobs.claim(processes - len(running))
+                    # Never share the connection with the processes forked below
+                    connections.close_all()
+                if not ids and not running and options['once']:
+                    break
+
+                for job_id in ids:
+                    self.stdout.write(f"Running job {job_id}.")
+                    future = pool.submit(run_job, job_id)
+                    future.add_done_callback(lambda future, job_id=job_id: self.finished(future, job_id))
+                    running.add(future)
+                stopping.wait(options['poll_interval'])
+
+    def finished(self, future, job_id):
+        error = future.exception()
+        if error is not None:
+            # The process died without marking the job (e.g. it was killed)
+            Job.objects.filter(pk=job_id, status=Job.Status.RUNNING).update(
+                status=Job.Status.FAILED, error=f"{type(error).__name__}: {error}", finished_at=timezone.now(),
+            )
+            connections.close_all()
+        self.stdout.write(f"Job {job_id} finished.")
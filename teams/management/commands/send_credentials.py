@@ -0,0 +1,124 @@
+import signal
+import threading
+import time
+
+from allauth.account.models import EmailAddress
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.mail import EmailMessage
+from django.core.management.base import BaseCommand, CommandError
+from django.shortcuts import resolve_url
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from teams.credentials import credentials_for, provision_credentials
+from teams.mail import MailPool
+from teams.models import User
+
+
+class Command(BaseCommand):
+    help = """
+        Email the contest credentials (the same as in accounts.csv of the
+        export) to the verified students subscribed to email updates, over
+        parallel connections and with a limit on the emails per second.
+        Every student is marked as soon as their email is sent, so a run that
+        was interrupted can be started again and only emails the others;
+        the failed emails are sent again by the next run.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50, help="Students marked as done at a time")
+        parser.add_argument('--threads', type=int, default=8, help="Emails sent in parallel, each over its own connection")
+        parser.add_argument('--rate', type=float, default=20, help="Maximum emails per second, 0 for no limit")
+        parser.add_argument('--limit', type=int, help="Send at most this many emails, e.g. to try a few first")
+        parser.add_argument('--dry-run', action='store_true', help="Only count the students who would get an email")
+        parser.add_argument('--backend', default=settings.OUTBOX_EMAIL_BACKEND,
+                            help="Email backend that delivers the emails (default: %(default)s), e.g. "
+                            "django.core.mail.backends.smtp.EmailBackend to test against a local SMTP server")
+
+    def handle(self, *args, **options):
+        if not settings.CAN_DISCLOSE_CREDENTIALS:
+            raise CommandError("CAN_DISCLOSE_CREDENTIALS is False, the credentials can't be sent yet.")
+
+        users = User.objects.filter(is_verified=True, subscribed=True, credentials_sent_at=None).order_by('id')
+        total = users.count()
+        if options['limit'] is not None:
+            total = min(total, options['limit'])
+        if options['dry_run']:
+            self.stdout.write(f"{total} students would get their credentials.")
+            return
+
+        users = users.select_related('team').only(
+            'email', 'first_name', 'last_name', 'credentials', 'team', 'team__name',
+        )
+        profile_url = f"https://{Site.objects.get_current().domain}{resolve_url('my-profile')}"
+
+        stopping = threading.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            # Finish (and mark) the current batch, then exit
+            signal.signal(signum, lambda signum, frame: stopping.set())
+
+        sent = failed = 0
+        after = 0
+        start = time.monotonic()
+        with MailPool(options['backend'], options['threads'], options['rate']) as pool:
+            while not stopping.is_set() and sent + failed < total:
+                # Before every batch, for the students verified during the run
+                provision_credentials()
+                batch = list(users.filter(id__gt=after)[:min(options['batch_size'], total - sent - failed)])
+                if not batch:
+                    break
+                # Failed students are left for the next run
+                after = batch[-1].id
+
+                messages = self.messages(batch, profile_url)
+                errors = pool.send([message for _, message in messages])
+                done = [user.id for (user, _), error in zip(messages, errors) if error is None]
+                User.objects.filter(id__in=done).update(credentials_sent_at=timezone.now())
+
+                for (user, message), error in zip(messages, errors):
+                    if error is not None:
+                        self.stderr.write(f"Could not send the credentials of {user} to {', '.join(message.to)}: {error}")
+                sent += len(done)
+                failed += len(batch) - len(done)
+                elapsed = time.monotonic() - start
+                self.stdout.write(f"{sent + failed}/{total} students, {sent / max(elapsed, 1e-3):.1f} emails/s")
+
+        elapsed = time.monotonic() - start
+        style = self.style.SUCCESS if not failed and sent == total else self.style.WARNING
+        self.stdout.write(style(
+            f"Sent {sent} emails in {elapsed:.1f}s ({sent / max(elapsed, 1e-3):.1f} emails/s), {failed} failed, "
+            f"{total - sent - failed} left."
+        ))
+
+    def messages(self, users, profile_url):
+        # Like accounts.csv, the credentials go to all the verified addresses
+        # (is_verified users confirmed at least their account email)
+        addresses = {}
+        for user_id, email in (
+            EmailAddress.objects.filter(user__in=users, verified=True).order_by('id').values_list('user_id', 'email')
+        ):
+            addresses.setdefault(user_id, []).append(email)
+
+        messages = []
+        for user in users:
+            credentials = credentials_for(user)
+            if credentials is None:
+                # Verified right after provision_credentials(): counted as
+                # failed, and emailed by the next run
+                self.stderr.write(f"{user} has no credentials yet, they are left for the next run.")
+                continue
+            context = {
+                "name": user.full_name,
+                "team_name": user.team.name if user.team else user.full_name,
+                "username": credentials['username'],
+                "password": credentials['password'],
+                "profile_url": profile_url,
+            }
+            messages.append((user, EmailMessage(
+                subject=render_to_string('teams/email/credentials_subject.txt', context).strip(),
+                body=render_to_string('teams/email/credentials_message.txt', context),
+                from_email=settings.DEFAULT_FROM_EMAIL,
+                to=addresses.get(user.id) or [user.email],
+            )))
+        return messages
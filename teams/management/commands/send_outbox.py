@@ -0,0 +1,106 @@
+import random
+import signal
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from teams.mail import MailPool, from_outbox
+from teams.models import OutboxEmail
+
+# Claimed emails are skipped by the other workers for this long, so that the
+# emails of a worker that was killed while sending them are sent again later
+LEASE = timedelta(minutes=10)
+
+# Failed attempts are retried after 30s, 1m, 2m, ... (minus up to a half, so
+# that the retries of a batch don't hit the provider all together)
+BACKOFF = timedelta(seconds=30)
+MAX_BACKOFF = timedelta(hours=1)
+
+
+def backoff(attempts):
+    delay = min(BACKOFF * 2 ** (attempts - 1), MAX_BACKOFF)
+    return delay * random.uniform(0.5, 1)
+
+
+class Command(BaseCommand):
+    help = """
+        Deliver the emails queued by teams.mail.OutboxEmailBackend through
+        OUTBOX_EMAIL_BACKEND (or --backend), in batches, over parallel
+        connections and with a limit on the emails per second. Failed emails
+        are retried with exponential backoff. Runs until SIGTERM, or until
+        the outbox is empty with --once.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help="Emails claimed from the DB at a time")
+        parser.add_argument('--threads', type=int, default=4, help="Emails sent in parallel, each over its own connection")
+        parser.add_argument('--rate', type=float, default=10, help="Maximum emails per second, 0 for no limit")
+        parser.add_argument('--max-attempts', type=int, default=8, help="Give up on an email after this many failures")
+        parser.add_argument('--poll-interval', type=float, default=2, help="Seconds between checks of an empty outbox")
+        parser.add_argument('--once', action='store_true', help="Exit when there is nothing left to send right now")
+        parser.add_argument('--backend', default=settings.OUTBOX_EMAIL_BACKEND,
+                            help="Email backend that delivers the emails (default: %(default)s), e.g. "
+                            "django.core.mail.backends.smtp.EmailBackend to test against a local SMTP server")
+
+    def handle(self, *args, **options):
+        if options['backend'] == 'teams.mail.OutboxEmailBackend':
+            raise CommandError("The delivery backend can't be the outbox itself.")
+
+        stopping = threading.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            # Finish the current batch, then exit
+            signal.signal(signum, lambda signum, frame: stopping.set())
+
+        with MailPool(options['backend'], options['threads'], options['rate']) as pool:
+            while not stopping.is_set():
+                close_old_connections()
+                emails = self.claim(options['batch_size'])
+                if not emails:
+                    if options['once']:
+                        break
+                    stopping.wait(options['poll_interval'])
+                    continue
+                self.deliver(pool, emails, options['max_attempts'])
+
+    def claim(self, batch_size):
+        now = timezone.now()
+        with transaction.atomic():
+            emails = list(
+                OutboxEmail.objects.filter(sent_at=None, failed=False, next_attempt_at__lte=now)
+                .select_for_update(skip_locked=True).order_by('next_attempt_at')[:batch_size]
+            )
+            OutboxEmail.objects.filter(pk__in=[email.pk for email in emails]).update(next_attempt_at=now + LEASE)
+        return emails
+
+    def deliver(self, pool, emails, max_attempts):
+        start = time.monotonic()
+        errors = pool.send([from_outbox(email) for email in emails])
+        elapsed = time.monotonic() - start
+
+        now = timezone.now()
+        retrying = failed = 0
+        for email, error in zip(emails, errors):
+            email.attempts += 1
+            if error is None:
+                email.sent_at = now
+                email.last_error = ''
+                continue
+            email.last_error = f"{type(error).__name__}: {error}"
+            if email.attempts >= max_attempts:
+                email.failed = True
+                failed += 1
+            else:
+                email.next_attempt_at = now + backoff(email.attempts)
+                retrying += 1
+        OutboxEmail.objects.bulk_update(emails, ['attempts', 'sent_at', 'last_error', 'failed', 'next_attempt_at'])
+
+        sent = len(emails) - retrying - failed
+        self.stdout.write(
+            f"Sent {sent}, retrying {retrying}, failed {failed} "
+            f"in {elapsed:.1f}s ({len(emails) / max(elapsed, 1e-3):.1f} emails/s)."
+        )
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from teams.credentials import BATCH_SIZE, derived_credentials
+from teams.models import User
+
+
+class Command(BaseCommand):
+    help = """
+        Save the credentials derived from CREDENTIALS_SECRET in
+        User.credentials, for the verified students who don't have stored
+        ones yet, so that they keep working after changing
+        CREDENTIALS_SECRET or going back to CREDENTIALS_ENGINE = "stored".
+    """
+
+    def handle(self, *args, **options):
+        if settings.CREDENTIALS_ENGINE != 'hmac':
+            raise CommandError('CREDENTIALS_ENGINE is not "hmac", there are no derived credentials to store.')
+
+        with transaction.atomic():
+            ids = list(
+                User.objects.select_for_update()
+                .filter(is_verified=True, credentials__isnull=True)
+                .values_list('id', flat=True)
+            )
+            users = [User(id=id, credentials=derived_credentials(id)) for id in ids]
+            User.objects.bulk_update(users, ['credentials'], batch_size=BATCH_SIZE)
+
+        self.stdout.write(self.style.SUCCESS(f"Stored the credentials of {len(users)} students."))
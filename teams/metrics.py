@@ -0,0 +1,291 @@
+"""
+Prometheus metrics shared by all the gunicorn workers.
+
+Every process writes its own values to an mmap-ed file in METRICS_DIR, and
+the metrics view adds up the files of all the processes. Counters and
+histograms only grow, so the files of the workers that exited are still
+counted; the in-progress gauge is removed together with its worker (see the
+`child_exit` hook in gunicorn.conf.py). The directory is emptied when
+gunicorn starts.
+"""
+
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+INITIAL_SIZE = 64 * 1024
+
+# Every entry is the length of the key, the key (padded to 8 bytes) and the value
+HEADER = struct.Struct('<I4x')
+LENGTH = struct.Struct('<I')
+VALUE = struct.Struct('<d')
+
+
+def _padded(n):
+    return n + (-n % 8)
+
+
+def _entries(data, used):
+    pos = HEADER.size
+    while pos < used:
+        length, = LENGTH.unpack_from(data, pos)
+        key = bytes(data[pos + LENGTH.size:pos + LENGTH.size + length]).decode()
+        value_pos = pos + _padded(LENGTH.size + length)
+        value, = VALUE.unpack_from(data, value_pos)
+        yield key, value, value_pos
+        pos = value_pos + VALUE.size
+
+
+class ValueFile:
+    """
+    Values of one process, only written by that process.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, 'a+b')
+        size = os.fstat(self.file.fileno()).st_size
+        if size < INITIAL_SIZE:
+            self.file.truncate(INITIAL_SIZE)
+            size = INITIAL_SIZE
+        self.mmap = mmap.mmap(self.file.fileno(), size)
+        self.used, = HEADER.unpack_from(self.mmap, 0)
+        if not self.used:
+            self.used = HEADER.size
+            HEADER.pack_into(self.mmap, 0, self.used)
+        self.positions = {key: pos for key, _, pos in _entries(self.mmap, self.used)}
+
+    def add(self, key, amount):
+        with self.lock:
+            pos = self.positions.get(key)
+            if pos is None:
+                pos = self._append(key)
+            value, = VALUE.unpack_from(self.mmap, pos)
+            VALUE.pack_into(self.mmap, pos, value + amount)
+
+    def _append(self, key):
+        encoded = key.encode()
+        size = _padded(LENGTH.size + len(encoded)) + VALUE.size
+        while self.used + size > len(self.mmap):
+            self.mmap.close()
+            self.file.truncate(2 * os.fstat(self.file.fileno()).st_size)
+            self.mmap = mmap.mmap(self.file.fileno(), os.fstat(self.file.fileno()).st_size)
+
+        LENGTH.pack_into(self.mmap, self.used, len(encoded))
+        self.mmap[self.used + LENGTH.size:self.used + LENGTH.size + len(encoded)] = encoded
+        pos = self.used + _padded(LENGTH.size + len(encoded))
+        VALUE.pack_into(self.mmap, pos, 0.0)
+
+        # Readers only look up to `used`, so move it after the entry is complete
+        self.used = pos + VALUE.size
+        HEADER.pack_into(self.mmap, 0, self.used)
+        self.positions[key] = pos
+        return pos
+
+
+_files = {}
+_files_lock = threading.Lock()
+
+
+def _value_file(kind):
+    # Keyed by pid too, in case the module is imported before gunicorn forks
+    pid = os.getpid()
+    with _files_lock:
+        if (kind, pid) not in _files:
+            os.makedirs(settings.METRICS_DIR, exist_ok=True)
+            _files[kind, pid] = ValueFile(os.path.join(settings.METRICS_DIR, f'{kind}_{pid}.db'))
+        return _files[kind, pid]
+
+
+METRICS = []
+
+
+class Metric:
+    type = None
+    kind = 'counter'
+    # Suffix of the name in the HELP and TYPE lines
+    suffix = ''
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        METRICS.append(self)
+
+    def _add(self, suffix, labels, amount):
+        if not settings.METRICS_ENABLED:
+            return
+        if set(labels) - set(self.labels) - {'le'}:
+            raise ValueError(f"Unknown labels for {self.name}: {labels}")
+        key = json.dumps([self.name, suffix, sorted(labels.items())])
+        _value_file(self.kind).add(key, amount)
+
+
+class Counter(Metric):
+    type = 'counter'
+    suffix = '_total'
+
+    def inc(self, amount=1, **labels):
+        self._add('_total', labels, amount)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        self._add('', labels, amount)
+
+    def dec(self, amount=1, **labels):
+        self._add('', labels, -amount)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets, labels=()):
+        super().__init__(name, documentation, labels)
+        self.buckets = list(buckets) + [math.inf]
+
+    def observe(self, value, **labels):
+        for bucket in self.buckets:
+            if value <= bucket:
+                self._add('_bucket', {**labels, 'le': _format_value(bucket)}, 1)
+        self._add('_count', labels, 1)
+        self._add('_sum', labels, value)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def collect():
+    """
+    Values of all the processes, added up.
+    """
+    totals = {}
+    try:
+        names = sorted(os.listdir(settings.METRICS_DIR))
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        if not name.endswith('.db'):
+            continue
+        try:
+            with open(os.path.join(settings.METRICS_DIR, name), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            continue
+        if len(data) < HEADER.size:
+            continue
+        used, = HEADER.unpack_from(data, 0)
+        for key, value, _ in _entries(data, min(used, len(data))):
+            totals[key] = totals.get(key, 0.0) + value
+    return totals
+
+
+def render():
+    """
+    All the metrics in the Prometheus text format.
+    """
+    samples = {}
+    for key, value in collect().items():
+        name, suffix, labels = json.loads(key)
+        samples.setdefault(name, []).append((suffix, labels, value))
+
+    def sort_key(sample):
+        suffix, labels, _ = sample
+        # Buckets in increasing order, as required by Prometheus
+        le = dict(labels).get('le')
+        return [(k, v) for k, v in labels if k != 'le'], suffix, float(le.replace('+Inf', 'inf')) if le else 0
+
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name}{metric.suffix} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name}{metric.suffix} {metric.type}")
+        for suffix, labels, value in sorted(samples.get(metric.name, []), key=sort_key):
+            label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+            if label_text:
+                label_text = f"{{{label_text}}}"
+            lines.append(f"{metric.name}{suffix}{label_text} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+requests_total = Counter(
+    'itacpc_requests', "HTTP requests handled, by view and status code.",
+    labels=['view', 'method', 'status'],
+)
+request_duration = Histogram(
+    'itacpc_request_duration_seconds', "Time spent handling a request, by view.",
+    buckets=[0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+    labels=['view'],
+)
+request_queries = Histogram(
+    'itacpc_request_db_queries', "Number of DB queries issued by a request, by view.",
+    buckets=[0, 1, 2, 5, 10, 20, 50, 100],
+    labels=['view'],
+)
+requests_in_progress = Gauge(
+    'itacpc_requests_in_progress', "Requests being handled right now, across all the workers.",
+)
+registration_events = Counter(
+    'itacpc_registration_events', "Signups, team creations, joins and leaves.",
+    labels=['event'],
+)
+export_duration = Histogram(
+    'itacpc_export_duration_seconds', "Time spent generating an export, by file.",
+    buckets=[0.1, 0.5, 1, 5, 10, 30, 60, 120, 300],
+    labels=['key'],
+)
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = 0
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        requests_in_progress.inc()
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(count_queries):
+                response = self.get_response(request)
+        finally:
+            requests_in_progress.dec()
+
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        request_duration.observe(time.perf_counter() - start, view=view)
+        request_queries.observe(queries, view=view)
+        requests_total.inc(view=view, method=request.method, status=str(response.status_code))
+        return response
+
+
+def is_local(request):
+    # Behind nginx the client address is in X-Real-IP (set by proxy_params)
+    address = request.META.get('HTTP_X_REAL_IP') or request.META.get('REMOTE_ADDR')
+    return address in ('127.0.0.1', '::1')
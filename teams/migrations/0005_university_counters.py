@@ -0,0 +1,39 @@
+# Generated by Django 5.1.12 on 2026-10-18 19:36
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def populate_counters(apps, schema_editor):
+    University = apps.get_model("teams", "University")
+    Team = apps.get_model("teams", "Team")
+    User = apps.get_model("teams", "User")
+
+    teams = dict(Team.objects.values_list("university").annotate(n=Count("id")))
+    students = dict(User.objects.values_list("university").annotate(n=Count("id")))
+
+    for university in University.objects.all():
+        university.team_count = teams.get(university.id, 0)
+        university.student_count = students.get(university.id, 0)
+        university.save(update_fields=["team_count", "student_count"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("teams", "0004_user_credentials"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="university",
+            name="student_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="university",
+            name="team_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.1.12 on 2026-10-18 20:02
+
+from django.db import migrations, models
+
+
+def populate_search_documents(apps, schema_editor):
+    User = apps.get_model("teams", "User")
+
+    users = list(User.objects.select_related("team", "university"))
+    for user in users:
+        values = [
+            user.codeforces_handle, user.email, user.first_name,
+            user.github_handle, user.kattis_handle, user.last_name,
+            user.olinfo_handle,
+            user.team.name if user.team_id else None,
+            user.university.name if user.university_id else None,
+        ]
+        user.search_document = "\n".join(v for v in values if v).lower()
+    User.objects.bulk_update(users, ["search_document"], batch_size=1000)
+
+
+def create_trigram_index(apps, schema_editor):
+    # The dev SQLite database is small enough to be searched with a plain LIKE
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    schema_editor.execute(
+        "CREATE INDEX teams_user_search_trgm ON teams_user "
+        "USING gin (search_document gin_trgm_ops)"
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute("DROP INDEX IF EXISTS teams_user_search_trgm")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("teams", "0005_university_counters"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="search_document",
+            field=models.TextField(blank=True, default="", editable=False),
+        ),
+        migrations.RunPython(populate_search_documents, migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.12 on 2026-10-18 20:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("teams", "0006_user_search_document"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="team",
+            name="secret",
+            field=models.CharField(max_length=200, unique=True),
+        ),
+        migrations.AlterField(
+            model_name="teamjoinevent",
+            name="created_at",
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name="user",
+            index=models.Index(
+                condition=models.Q(("team", None)),
+                fields=["university"],
+                name="user_unassigned_by_university",
+            ),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.1.12 on 2026-10-18 20:40
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def populate_member_counts(apps, schema_editor):
+    Team = apps.get_model("teams", "Team")
+
+    teams = list(Team.objects.annotate(n=Count("user")))
+    # The constraint added below would fail on the teams that are already
+    # overfilled, they have to be fixed by hand first
+    overfilled = [team for team in teams if team.n > 3]
+    if overfilled:
+        raise RuntimeError(
+            "These teams have more than 3 members, move the extra members out of them and migrate again:\n"
+            + "\n".join(f"  {team.name} (id {team.pk}): {team.n} members" for team in overfilled)
+        )
+
+    for team in teams:
+        team.member_count = team.n
+    Team.objects.bulk_update(teams, ["member_count"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("teams", "0007_lookup_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="team",
+            name="member_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_member_counts, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="team",
+            constraint=models.CheckConstraint(
+                condition=models.Q(("member_count__lte", 3)),
+                name="team_member_count_lte_3",
+            ),
+        ),
+    ]
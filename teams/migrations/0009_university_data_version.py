@@ -0,0 +1,24 @@
+# Generated by Django 5.1.12 on 2026-10-18 21:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("teams", "0008_team_member_count"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="university",
+            name="data_changed_at",
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddField(
+            model_name="university",
+            name="data_version",
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+    ]
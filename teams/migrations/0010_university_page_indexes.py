@@ -0,0 +1,29 @@
+# Generated by Django 5.1.12 on 2026-10-18 21:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("teams", "0009_university_data_version"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="user",
+            name="user_unassigned_by_university",
+        ),
+        migrations.AddIndex(
+            model_name="team",
+            index=models.Index(fields=["university", "id"], name="team_by_university"),
+        ),
+        migrations.AddIndex(
+            model_name="user",
+            index=models.Index(
+                condition=models.Q(("team", None)),
+                fields=["university", "id"],
+                name="user_unassigned_by_university",
+            ),
+        ),
+    ]
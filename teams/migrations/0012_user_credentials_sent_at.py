@@ -0,0 +1,18 @@
+# Generated by Django 5.1.12 on 2026-10-18 21:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("teams", "0011_outboxemail"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="credentials_sent_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
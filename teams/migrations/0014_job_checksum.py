@@ -0,0 +1,30 @@
+# Generated by Django 5.1.12 on 2026-10-18 22:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("teams", "0013_job"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="job",
+            name="checksum",
+            field=models.CharField(
+                blank=True, help_text="SHA-256 of the artifact", max_length=64
+            ),
+        ),
+        migrations.AddField(
+            model_name="job",
+            name="size",
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="job",
+            name="version",
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
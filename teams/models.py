@@ -1,12 +1,21 @@
+import threading
+from contextlib import contextmanager
 from typing import Any
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 from django.contrib.sites.models import Site
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, Max, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete
 from django.shortcuts import resolve_url
 from django.templatetags.static import static
+from django.utils import timezone
+from allauth.account.models import EmailAddress
 from allauth.account.signals import email_confirmed
 from django.dispatch import receiver
 
+from teams import metrics
+
 
 @receiver(email_confirmed)
 def verify_user_when_email_confirmed(request, email_address, **kwargs):
@@ -22,6 +31,16 @@ class University(models.Model):
     kattis_subdivision = models.CharField(max_length=200, null=True, blank=True)
     active = models.BooleanField(default=True)
 
+    # Denormalized counters, kept up to date by the signal handlers at the
+    # bottom of this module (see also `manage.py rebuild_counters`)
+    team_count = models.PositiveIntegerField(default=0, editable=False)
+    student_count = models.PositiveIntegerField(default=0, editable=False)
+
+    # Bumped whenever something shown on the index or on the university page
+    # changes, to answer conditional requests and to key the page cache
+    data_version = models.PositiveBigIntegerField(default=0, editable=False)
+    data_changed_at = models.DateTimeField(default=timezone.now, editable=False)
+
     def __str__(self) -> str:
         return f"{self.name}"
 
@@ -30,14 +49,30 @@ class University(models.Model):
         return static(f"flags/300/{self.short_name}.png")
 
 
+MAX_TEAM_MEMBERS = 3
+
+
 class Team(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     name = models.CharField(max_length=200, unique=True)
     university = models.ForeignKey(University, on_delete=models.SET_NULL, null=True)
-    secret = models.CharField(max_length=200)
+    secret = models.CharField(max_length=200, unique=True)
     creation_date = models.DateTimeField(auto_now_add=True)
     credentials = models.JSONField(null=True, blank=True)
 
+    # Denormalized number of members, kept up to date like the counters of
+    # University and capped at the database level
+    member_count = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(condition=models.Q(member_count__lte=MAX_TEAM_MEMBERS), name='team_member_count_lte_3'),
+        ]
+        indexes = [
+            # Teams of a university, one page at a time (see views.university)
+            models.Index(fields=['university', 'id'], name='team_by_university'),
+        ]
+
     def __str__(self) -> str:
         return self.name
 
@@ -79,12 +114,24 @@ class User(AbstractUser):
     olinfo_handle = models.CharField(max_length=200, null=True, blank=True)
     github_handle = models.CharField(max_length=200, null=True, blank=True)
     credentials = models.JSONField(null=True, blank=True)
+    # Set by `manage.py send_credentials`, so that a new run skips the user
+    credentials_sent_at = models.DateTimeField(null=True, blank=True)
+
+    # Lowercase concatenation of all the fields searched from the admin, so
+    # that a search is a single (trigram indexed) lookup on this column
+    search_document = models.TextField(default='', blank=True, editable=False)
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['first_name', 'last_name', 'university_id']  # for manage.py createsuperuser
 
     objects = UserManager()
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Individual participants of a university, one page at a time (see views.university)
+            models.Index(fields=['university', 'id'], condition=models.Q(team=None), name='user_unassigned_by_university'),
+        ]
+
     def __str__(self) -> str:
         return self.full_name
 
@@ -92,12 +139,355 @@ class User(AbstractUser):
     def full_name(self):
         return f"{self.first_name} {self.last_name}"
 
+    SEARCH_SOURCE_FIELDS = {
+        'codeforces_handle', 'email', 'first_name', 'github_handle',
+        'kattis_handle', 'last_name', 'olinfo_handle', 'team', 'university',
+    }
+
+    def build_search_document(self):
+        values = [
+            self.codeforces_handle, self.email, self.first_name,
+            self.github_handle, self.kattis_handle, self.last_name,
+            self.olinfo_handle,
+            self.team.name if self.team_id else None,
+            self.university.name if self.university_id else None,
+        ]
+        return "\n".join(v for v in values if v).lower()
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or not self.SEARCH_SOURCE_FIELDS.isdisjoint(update_fields):
+            self.search_document = self.build_search_document()
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'search_document'}
+        super().save(*args, **kwargs)
+
 
 class TeamJoinEvent(models.Model):
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
     team = models.ForeignKey(Team, on_delete=models.SET_NULL, null=True)
     joining = models.BooleanField()
 
     def __str__(self) -> str:
         return f"{self.user} {'joined' if self.joining else 'left'} team {self.team} on {self.created_at}"
+
+
+class OutboxEmail(models.Model):
+    """
+    An email queued by teams.mail.OutboxEmailBackend, delivered by
+    `manage.py send_outbox`.
+    """
+    created_at = models.DateTimeField(auto_now_add=True)
+    subject = models.TextField()
+    body = models.TextField()
+    from_email = models.TextField()
+    to = models.JSONField(default=list)
+    cc = models.JSONField(default=list)
+    bcc = models.JSONField(default=list)
+    reply_to = models.JSONField(default=list)
+    headers = models.JSONField(default=dict)
+    # [content, mimetype] pairs, e.g. the HTML version of the body
+    alternatives = models.JSONField(default=list)
+    # [filename, base64 content, mimetype] triples
+    attachments = models.JSONField(default=list)
+
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    failed = models.BooleanField(default=False)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            # The worker only looks at the emails still to be sent
+            models.Index(fields=['next_attempt_at'], condition=models.Q(sent_at=None, failed=False), name='outbox_pending'),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.subject} to {', '.join(self.to)}"
+
+
+class Job(models.Model):
+    """
+    A background job (see teams/jobs.py), run by `manage.py run_jobs`.
+    """
+    class Status(models.TextChoices):
+        QUEUED = 'queued'
+        RUNNING = 'running'
+        DONE = 'done'
+        FAILED = 'failed'
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    kind = models.CharField(max_length=100)
+    args = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.QUEUED)
+    # Items processed so far, out of `total` if known
+    progress = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(null=True, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    # Path of the file produced by the job, relative to ARTIFACTS_DIR
+    artifact = models.CharField(max_length=300, blank=True)
+    checksum = models.CharField(max_length=64, blank=True, help_text="SHA-256 of the artifact")
+    size = models.PositiveBigIntegerField(null=True, blank=True)
+    # Version of the data the job ran on (e.g. data_version() for the exports)
+    version = models.CharField(max_length=100, blank=True)
+
+    class Meta:
+        indexes = [
+            # The worker only looks at the queued jobs
+            models.Index(fields=['created_at'], condition=models.Q(status='queued'), name='job_queued'),
+        ]
+
+    def __str__(self) -> str:
+        args = ", ".join(f"{name}={value}" for name, value in self.args.items())
+        return f"{self.kind}({args}) #{self.pk}"
+
+    @property
+    def artifact_name(self):
+        return self.artifact.rsplit('/', 1)[-1]
+
+    @property
+    def duration(self):
+        if self.started_at and self.finished_at:
+            return self.finished_at - self.started_at
+        return None
+
+
+def _count(queryset, field):
+    # Number of rows of queryset pointing to the outer row through field
+    counts = queryset.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(n=Count('id')).values('n')
+    return Coalesce(Subquery(counts), 0)
+
+
+def rebuild_counters():
+    with transaction.atomic():
+        # Lock the universities so that no counter moves while we recount
+        list(University.objects.select_for_update().values_list('id'))
+
+        University.objects.update(
+            team_count=_count(Team.objects.all(), 'university'),
+            student_count=_count(User.objects.all(), 'university'),
+            data_version=F('data_version') + 1,
+            data_changed_at=timezone.now(),
+        )
+        Team.objects.update(member_count=_count(User.objects.all(), 'team'))
+
+
+_bookkeeping = threading.local()
+
+
+@contextmanager
+def bulk_changes():
+    """
+    Skip the per-row bookkeeping of the signal handlers below (counters and
+    search documents) while deleting or changing many rows at once, and
+    rebuild the counters at the end instead.
+    """
+    _bookkeeping.suspended = True
+    try:
+        with transaction.atomic():
+            yield
+            rebuild_counters()
+    finally:
+        _bookkeeping.suspended = False
+
+
+def _move_counter(model, field, old_id, new_id):
+    if old_id == new_id:
+        return
+    if old_id is not None:
+        model.objects.filter(pk=old_id).update(**{field: F(field) - 1})
+    if new_id is not None:
+        model.objects.filter(pk=new_id).update(**{field: F(field) + 1})
+
+
+@receiver(post_init, sender=Team)
+@receiver(post_init, sender=User)
+def remember_counted_university(sender, instance, **kwargs):
+    # Read from __dict__ so that deferred fields don't trigger a query
+    instance._counted_university_id = instance.__dict__.get('university_id')
+    if sender is User:
+        instance._counted_team_id = instance.__dict__.get('team_id')
+
+
+# Columns of the members shown on the university page and by the API
+MEMBER_COLUMNS = [
+    'team', 'first_name', 'last_name', 'is_staff', 'is_verified', 'is_swerc_eligible',
+    'kattis_handle', 'olinfo_handle', 'codeforces_handle', 'github_handle',
+]
+
+# Fields shown on the index and on the university pages
+PAGE_FIELDS = {
+    Team: {'name', 'university'},
+    User: {'university', *MEMBER_COLUMNS},
+}
+
+
+def bump_data_version(university_ids):
+    University.objects.filter(pk__in=university_ids).update(
+        data_version=F('data_version') + 1,
+        data_changed_at=timezone.now(),
+    )
+
+
+def data_version():
+    """
+    Version of the data of all the universities, and when it last changed.
+    Their versions only go up, and the version of a deleted university is
+    carried over to another one, so their sum does too. The highest id keeps
+    the versions apart when all of them were deleted and new ones created.
+    """
+    versions = University.objects.aggregate(
+        last_id=Max('id'), total=Sum('data_version'), changed_at=Max('data_changed_at'),
+    )
+    if versions['last_id'] is None:
+        return None, None
+    return f"{versions['last_id']}.{versions['total']}", versions['changed_at']
+
+
+def university_data_version(university_short_name):
+    version = University.objects.filter(short_name=university_short_name).values_list(
+        'id', 'data_version', 'data_changed_at',
+    ).first()
+    if version is None:
+        return None, None
+    id, version, changed_at = version
+    return f"{id}.{version}", changed_at
+
+
+# Connected before the counters, which overwrite _counted_university_id
+@receiver(post_save, sender=Team)
+@receiver(post_save, sender=User)
+def bump_data_version_on_save(sender, instance, created, raw, update_fields, **kwargs):
+    if raw or getattr(_bookkeeping, 'suspended', False):
+        return
+    if update_fields is not None and not PAGE_FIELDS[sender] & set(update_fields):
+        # e.g. last_login, or the secret of a team
+        return
+    bump_data_version({instance._counted_university_id, instance.university_id} - {None})
+
+
+@receiver(post_delete, sender=Team)
+@receiver(post_delete, sender=User)
+def bump_data_version_on_delete(sender, instance, **kwargs):
+    if getattr(_bookkeeping, 'suspended', False):
+        return
+    bump_data_version({instance._counted_university_id} - {None})
+
+
+@receiver(post_save, sender=University)
+def bump_data_version_on_university_save(sender, instance, raw, **kwargs):
+    if not raw:
+        bump_data_version([instance.pk])
+
+
+@receiver(pre_delete, sender=University)
+def carry_data_version_on_university_delete(sender, instance, **kwargs):
+    # Otherwise the sum of the versions (see data_version) would go down, and
+    # later changes could bring it back to a version that was already served
+    version = University.objects.select_for_update().filter(pk=instance.pk).values_list('data_version', flat=True).first()
+    other = University.objects.exclude(pk=instance.pk).order_by('id').values_list('id', flat=True).first()
+    University.objects.filter(pk=other).update(
+        data_version=F('data_version') + (version or 0) + 1,
+        data_changed_at=timezone.now(),
+    )
+
+
+@receiver(post_save, sender=EmailAddress)
+@receiver(post_delete, sender=EmailAddress)
+def bump_data_version_on_email_change(sender, instance, raw=False, **kwargs):
+    # The verified addresses are part of the accounts export
+    if raw or getattr(_bookkeeping, 'suspended', False):
+        return
+    bump_data_version(User.objects.filter(pk=instance.user_id).values('university'))
+
+
+@receiver(post_save, sender=Team)
+@receiver(post_save, sender=User)
+def update_counters_on_save(sender, instance, created, raw, update_fields, **kwargs):
+    if raw or getattr(_bookkeeping, 'suspended', False):
+        return
+
+    if update_fields is None or 'university' in update_fields:
+        field = 'team_count' if sender is Team else 'student_count'
+        old_university_id = None if created else instance._counted_university_id
+        _move_counter(University, field, old_university_id, instance.university_id)
+        instance._counted_university_id = instance.university_id
+
+    if sender is User and (update_fields is None or 'team' in update_fields):
+        old_team_id = None if created else instance._counted_team_id
+        _move_counter(Team, 'member_count', old_team_id, instance.team_id)
+        instance._counted_team_id = instance.team_id
+
+
+@receiver(post_delete, sender=Team)
+@receiver(post_delete, sender=User)
+def update_counters_on_delete(sender, instance, **kwargs):
+    if getattr(_bookkeeping, 'suspended', False):
+        return
+    field = 'team_count' if sender is Team else 'student_count'
+    _move_counter(University, field, instance._counted_university_id, None)
+    if sender is User:
+        _move_counter(Team, 'member_count', instance._counted_team_id, None)
+
+
+def refresh_search_documents(users):
+    users = users.select_related('team', 'university')
+    for chunk in _chunked(users.iterator(chunk_size=1000), 1000):
+        for user in chunk:
+            user.search_document = user.build_search_document()
+        User.objects.bulk_update(chunk, ['search_document'])
+
+
+def _chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+@receiver(post_save, sender=Team)
+@receiver(post_save, sender=University)
+def refresh_search_documents_on_rename(sender, instance, created, raw, update_fields, **kwargs):
+    if created or raw or getattr(_bookkeeping, 'suspended', False) or (update_fields is not None and 'name' not in update_fields):
+        return
+    refresh_search_documents(instance.user_set.all())
+
+
+@receiver(pre_delete, sender=Team)
+def remember_team_members(sender, instance, **kwargs):
+    if getattr(_bookkeeping, 'suspended', False):
+        instance._member_ids = []
+        return
+    # The members are detached with a single UPDATE, so remember who they are
+    instance._member_ids = list(instance.user_set.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Team)
+def refresh_search_documents_on_delete(sender, instance, **kwargs):
+    if instance._member_ids:
+        refresh_search_documents(User.objects.filter(id__in=instance._member_ids))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Team)
+@receiver(post_save, sender=TeamJoinEvent)
+def count_registration_events(sender, instance, created, raw, **kwargs):
+    if not created or raw:
+        return
+    if sender is User:
+        event = 'signup'
+    elif sender is Team:
+        event = 'team_created'
+    else:
+        event = 'team_joined' if instance.joining else 'team_left'
+    # Rolled back changes (e.g. a full team) didn't happen
+    transaction.on_commit(lambda: metrics.registration_events.inc(event=event))
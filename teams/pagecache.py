@@ -0,0 +1,127 @@
+"""
+Conditional requests and cache of the index and university pages.
+
+Both are driven by the data version of the universities (see
+University.data_version), which is read with a single query before anything
+else. A client that already has the current version of a page gets a 304;
+otherwise anonymous visitors are served the render stored under that version,
+shared by all the workers. Changes bump the version in the same transaction,
+so a render that raced with a change is stored under the old version and is
+never served. The version goes together with the time of the change, since
+the version alone can repeat after the database is reset or restored.
+
+The ETags of the API (see api.versioned) are built the same way.
+"""
+
+import hashlib
+from functools import cache, wraps
+from pathlib import Path
+
+from django.contrib import messages
+from django.core.cache import cache as page_cache
+from django.http import HttpResponse, QueryDict
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+# Pages stored under old versions are never requested again, let them expire
+PAGE_TIMEOUT = 60 * 60
+
+TEMPLATES_DIR = Path(__file__).resolve().parent / 'templates'
+
+# Query parameters read by the views (see views.university): the others, e.g.
+# the ones added by link trackers, don't change the page
+PAGE_PARAMS = ['teams_after', 'students_after', 'fragment']
+
+
+@cache
+def templates_version():
+    """
+    Digest and modification time of the templates, so that a deploy that
+    changes them doesn't answer 304 with the old pages.
+    """
+    digest = hashlib.sha256()
+    last_modified = 0
+    for path in sorted(TEMPLATES_DIR.rglob('*.html')):
+        digest.update(path.read_bytes())
+        last_modified = max(last_modified, path.stat().st_mtime)
+    return digest.hexdigest()[:12], last_modified
+
+
+def page_query(request, params=PAGE_PARAMS):
+    """
+    The `params` of the request (the ones the view reads), always in the same
+    order.
+    """
+    query = QueryDict(mutable=True)
+    for name in params:
+        if name in request.GET:
+            query[name] = request.GET[name]
+    return query
+
+
+def version_tag(request, version, changed_at, params=PAGE_PARAMS):
+    """
+    The version of the data and the `params` of the request, which make
+    different pages (e.g. of a list), for the ETags and the cache keys.
+    """
+    query_digest = hashlib.sha256(page_query(request, params).urlencode().encode()).hexdigest()[:12]
+    return f'{version}.{changed_at.timestamp():.6f}-{query_digest}'
+
+
+def add_validators(response, etag, last_modified=None):
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    # Let the clients keep the response, but check that it's still current
+    patch_cache_control(response, no_cache=True)
+
+
+def versioned_page(version_func, personalized=True):
+    """
+    `version_func` gets the arguments of the view and returns the data version
+    of the page and when it changed, or (None, None) to leave the request to
+    the view (e.g. for a 404). Pages that are not `personalized` are the same
+    for everyone, logged in or not.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            # Messages are shown only once, so the page must be rendered
+            if request.method not in ('GET', 'HEAD') or len(messages.get_messages(request)):
+                return view(request, *args, **kwargs)
+
+            version, changed_at = version_func(*args, **kwargs)
+            if version is None:
+                return view(request, *args, **kwargs)
+
+            templates_digest, templates_modified = templates_version()
+            shared = not personalized or not request.user.is_authenticated
+            if not shared:
+                user = request.user
+                # Logged in users see pages that depend on their university and team
+                viewer = f'{user.pk}.{user.university_id}.{user.team_id}'
+                last_modified = None
+            else:
+                viewer = 'shared'
+                last_modified = int(max(changed_at.timestamp(), templates_modified))
+            tag = version_tag(request, version, changed_at)
+            etag = quote_etag(f'{templates_digest}-{tag}-{viewer}')
+
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is not None:
+                return response
+
+            key = f'page:{view.__name__}:{templates_digest}:{tag}'
+            content = page_cache.get(key) if shared else None
+            if content is not None:
+                response = HttpResponse(content)
+            else:
+                response = view(request, *args, **kwargs)
+                if response.status_code == 200 and shared:
+                    page_cache.set(key, response.content, PAGE_TIMEOUT)
+
+            if response.status_code == 200:
+                add_validators(response, etag, last_modified)
+            return response
+        return wrapper
+    return decorator
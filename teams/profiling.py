@@ -0,0 +1,136 @@
+"""
+Per-request profiling: SQL queries, template rendering and view time.
+
+Enabled with the PROFILING_ENABLED setting. When it is off the middleware
+removes itself from the stack at startup and nothing is instrumented.
+"""
+
+import contextvars
+import json
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.template.base import Template
+
+logger = logging.getLogger(__name__)
+
+# Profile of the request being handled by the current thread, if any
+current_profile = contextvars.ContextVar('current_profile', default=None)
+
+
+class Profile:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.view_start = None
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.template_depth = 0
+
+    def timings(self):
+        end = time.perf_counter()
+        return {
+            'db': self.db_time * 1000,
+            'template': self.template_time * 1000,
+            'view': (end - self.view_start) * 1000 if self.view_start else 0.0,
+            'total': (end - self.start) * 1000,
+        }
+
+
+def count_queries(execute, sql, params, many, context):
+    profile = current_profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.db_time += time.perf_counter() - start
+        profile.queries += 1
+
+
+def instrument_templates():
+    """
+    Time Template.render. Included and extended templates are rendered inside
+    the outermost one, so only the outermost call is counted.
+    """
+    if getattr(Template.render, 'profiled', False):
+        return
+    render = Template.render
+
+    def profiled_render(self, context):
+        profile = current_profile.get()
+        if profile is None:
+            return render(self, context)
+
+        profile.template_depth += 1
+        start = time.perf_counter()
+        try:
+            return render(self, context)
+        finally:
+            profile.template_depth -= 1
+            if not profile.template_depth:
+                profile.template_time += time.perf_counter() - start
+
+    profiled_render.profiled = True
+    Template.render = profiled_render
+
+
+class ProfilingMiddleware:
+    """
+    Send the timings of the request in a Server-Timing header to staff users,
+    and log a sample of them (and all the slow requests) to the
+    `teams.profiling` logger as JSON.
+    """
+
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        instrument_templates()
+
+    def __call__(self, request):
+        profile = Profile()
+        token = current_profile.set(profile)
+        try:
+            with connection.execute_wrapper(count_queries):
+                response = self.get_response(request)
+        finally:
+            current_profile.reset(token)
+
+        timings = profile.timings()
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_staff:
+            response['Server-Timing'] = ', '.join([
+                f'db;dur={timings["db"]:.1f};desc="{profile.queries} queries"',
+                f'tpl;dur={timings["template"]:.1f}',
+                f'view;dur={timings["view"]:.1f}',
+                f'total;dur={timings["total"]:.1f}',
+            ])
+
+        slow = timings['total'] >= settings.PROFILING_SLOW_MS
+        if slow or random.random() < settings.PROFILING_SAMPLE_RATE:
+            match = request.resolver_match
+            logger.info(json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'route': match.route if match else None,
+                'status': response.status_code,
+                'user': user.pk if user is not None else None,
+                'queries': profile.queries,
+                'db_ms': round(timings['db'], 1),
+                'template_ms': round(timings['template'], 1),
+                'view_ms': round(timings['view'], 1),
+                'total_ms': round(timings['total'], 1),
+                'slow': slow,
+            }))
+
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        current_profile.get().view_start = time.perf_counter()
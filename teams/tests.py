@@ -1,3 +1,1009 @@
-from django.test import TestCase
+import csv
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import signal
+import tempfile
+import threading
+import time
+from pathlib import Path
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from allauth.account.models import EmailAddress
+from django.core import mail
+from django.core.mail import EmailMultiAlternatives
+from django.core.mail.backends import locmem
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from teams import jobs
+from teams.checks import check_credentials_settings
+from teams.exports import export_chunks, export_job
+from teams.loadtest import traffic
+from teams.management.commands.send_outbox import BACKOFF, MAX_BACKOFF, backoff
+from teams.models import MAX_TEAM_MEMBERS, Job, OutboxEmail, Team, University, User, bump_data_version, data_version
+from teams.urls import urlpatterns
+
+TESTDATA_DIR = Path(__file__).resolve().parent / 'testdata'
+
+# Render the pages every time, instead of serving them from the page cache
+NO_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+
+# Seed of the generated data, far from the ones used by hand
+SEED = 900000
+
+
+@override_settings(CACHES=NO_CACHE)
+class UniversityPageQueriesTest(TestCase):
+    """
+    The university page runs the same number of queries whatever the number
+    of teams and students.
+    """
+
+    def setUp(self):
+        self.university = University.objects.create(short_name='uni', name='University', domain='*')
+        self.students = 0
+        self.add_teams(1)
+
+    def add_teams(self, count):
+        for _ in range(count):
+            team = Team.objects.create(
+                name=f'Team {Team.objects.count()}', university=self.university, secret=f'secret-{Team.objects.count()}',
+            )
+            for _ in range(MAX_TEAM_MEMBERS):
+                self.add_student(team)
+            self.add_student(None)
+
+    def add_student(self, team):
+        self.students += 1
+        return User.objects.create(
+            email=f'student{self.students}@example.com', first_name='Student', last_name=str(self.students),
+            university=self.university, team=team, is_verified=True,
+        )
+
+    def assertPageQueries(self, queries):
+        url = reverse('university', args=[self.university.short_name])
+        with self.assertNumQueries(queries):
+            response = self.client.get(url, secure=True)
+        self.assertEqual(response.status_code, 200)
+
+    def test_anonymous(self):
+        self.assertPageQueries(5)
+        self.add_teams(30)
+        self.assertPageQueries(5)
+
+    def test_team_member(self):
+        self.client.force_login(User.objects.filter(team__isnull=False).first())
+        self.assertPageQueries(8)
+        self.add_teams(30)
+        self.assertPageQueries(8)
+
+
+class CredentialsCheckTest(TestCase):
+    """
+    `manage.py check --deploy` fails on credentials settings that would give
+    no passwords, or passwords anyone can derive.
+    """
+
+    def assertCheck(self, engine, secret, error_id):
+        with override_settings(CREDENTIALS_ENGINE=engine, CREDENTIALS_SECRET=secret):
+            self.assertEqual([error.id for error in check_credentials_settings(None)], [error_id] if error_id else [])
+
+    def test_engine(self):
+        self.assertCheck('stored', '', None)
+        self.assertCheck('random', '', 'teams.E001')
+
+    def test_secret(self):
+        self.assertCheck('hmac', 'Zs3-rWh8MqU2pGa1vKx0', None)
+        self.assertCheck('hmac', '', 'teams.E002')
+        self.assertCheck('hmac', 'generate-a-new-secret-key-here', 'teams.E003')
+
+
+class LoadtestCleanupTest(TestCase):
+    """
+    The cleanup of the load test deletes what it created, including the
+    confirmation emails of its signups, and nothing else.
+    """
+
+    def test_cleanup(self):
+        university = University.objects.create(short_name='uni', name='University', domain='uni.example.org')
+        traffic.seed(3, [university])
+        User.objects.create(email='student@uni.example.org', university=university)
+        OutboxEmail.objects.create(subject="Confirm", body="", from_email="info@itacpc.it", to=[f'{traffic.PREFIX}1@uni.example.org'])
+        OutboxEmail.objects.create(subject="Confirm", body="", from_email="info@itacpc.it", to=['student@uni.example.org'])
+
+        self.assertEqual(traffic.cleanup(), (4, 0, 1))
+        self.assertEqual(list(User.objects.values_list('email', flat=True)), ['student@uni.example.org'])
+        self.assertEqual(list(OutboxEmail.objects.values_list('to', flat=True)), [['student@uni.example.org']])
+
+
+class FailingEmailBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        raise ConnectionError("The provider is down")
+
+
+# send_outbox closes the DB connection between batches, like the requests do,
+# which would end the transaction of a TestCase
+@override_settings(EMAIL_BACKEND='teams.mail.OutboxEmailBackend')
+class OutboxTest(TransactionTestCase):
+    """
+    The emails are queued in the outbox, and `manage.py send_outbox` delivers
+    them, retrying the failed ones later.
+    """
+
+    def setUp(self):
+        # send_outbox stops on SIGINT and SIGTERM instead of exiting
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+
+    def queue(self):
+        message = EmailMultiAlternatives("Welcome", "Hello!", "info@itacpc.it", ["student@example.org"])
+        message.attach_alternative("<p>Hello!</p>", "text/html")
+        message.attach("rules.txt", "No cheating.", "text/plain")
+        message.send()
+        return OutboxEmail.objects.get()
+
+    def send_outbox(self, backend='django.core.mail.backends.locmem.EmailBackend', max_attempts=8):
+        call_command('send_outbox', once=True, backend=backend, rate=0, max_attempts=max_attempts, stdout=io.StringIO())
+
+    def retry_now(self, email):
+        OutboxEmail.objects.filter(pk=email.pk).update(next_attempt_at=timezone.now())
+
+    def test_round_trip(self):
+        email = self.queue()
+        self.assertEqual(mail.outbox, [])
+
+        self.send_outbox()
+
+        [message] = mail.outbox
+        self.assertEqual((message.subject, message.body, message.from_email, message.to),
+                         ("Welcome", "Hello!", "info@itacpc.it", ["student@example.org"]))
+        self.assertEqual(message.alternatives, [("<p>Hello!</p>", "text/html")])
+        self.assertEqual(message.attachments, [("rules.txt", "No cheating.", "text/plain")])
+        email.refresh_from_db()
+        self.assertIsNotNone(email.sent_at)
+        self.assertEqual(email.attempts, 1)
+
+        # Sent only once
+        self.send_outbox()
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_retry(self):
+        email = self.queue()
+
+        before = timezone.now()
+        self.send_outbox(backend='teams.tests.FailingEmailBackend')
+        email.refresh_from_db()
+        self.assertIsNone(email.sent_at)
+        self.assertEqual(email.attempts, 1)
+        self.assertEqual(email.last_error, "ConnectionError: The provider is down")
+        self.assertGreaterEqual(email.next_attempt_at, before + BACKOFF / 2)
+        self.assertLessEqual(email.next_attempt_at, timezone.now() + BACKOFF)
+
+        # Not yet due
+        self.send_outbox()
+        self.assertEqual(mail.outbox, [])
+
+        self.retry_now(email)
+        self.send_outbox()
+        self.assertEqual(len(mail.outbox), 1)
+        email.refresh_from_db()
+        self.assertIsNotNone(email.sent_at)
+        self.assertEqual(email.attempts, 2)
+        self.assertEqual(email.last_error, '')
+
+    def test_give_up(self):
+        email = self.queue()
+        for _ in range(3):
+            self.retry_now(email)
+            self.send_outbox(backend='teams.tests.FailingEmailBackend', max_attempts=3)
+        email.refresh_from_db()
+        self.assertTrue(email.failed)
+        self.assertEqual(email.attempts, 3)
+
+        self.retry_now(email)
+        self.send_outbox()
+        self.assertEqual(mail.outbox, [])
+
+    def test_backoff(self):
+        for attempts in range(1, 20):
+            delay = min(BACKOFF * 2 ** (attempts - 1), MAX_BACKOFF)
+            self.assertTrue(delay / 2 <= backoff(attempts) <= delay, attempts)
+
+
+class InterruptingEmailBackend(locmem.EmailBackend):
+    """
+    Delivers like locmem, and interrupts the running command (as SIGINT
+    would) once it delivered INTERRUPT_AFTER emails.
+    """
+
+    INTERRUPT_AFTER = 4
+
+    def send_messages(self, email_messages):
+        sent = super().send_messages(email_messages)
+        if len(mail.outbox) == self.INTERRUPT_AFTER:
+            signal.getsignal(signal.SIGINT)(signal.SIGINT, None)
+        return sent
+
+
+@override_settings(CAN_DISCLOSE_CREDENTIALS=True)
+class SendCredentialsTest(TestCase):
+    """
+    A run of `manage.py send_credentials` interrupted in the middle of a batch
+    can be started again: nobody gets the credentials twice, nobody is left out.
+    """
+
+    def setUp(self):
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+        university = University.objects.create(short_name='uni', name='University', domain='*')
+        self.students = [
+            User.objects.create(email=f'student{i}@example.org', university=university, is_verified=True)
+            for i in range(8)
+        ]
+        User.objects.create(email='unverified@example.org', university=university)
+        User.objects.create(email='unsubscribed@example.org', university=university, is_verified=True, subscribed=False)
+
+    def send_credentials(self, backend):
+        call_command(
+            'send_credentials', backend=backend, batch_size=3, threads=1, rate=0,
+            stdout=io.StringIO(), stderr=io.StringIO(),
+        )
+
+    def test_interrupted(self):
+        self.send_credentials('teams.tests.InterruptingEmailBackend')
+        # The batch in progress is finished, the next ones are left
+        self.assertEqual(len(mail.outbox), 6)
+        self.assertEqual(User.objects.exclude(credentials_sent_at=None).count(), 6)
+
+        self.send_credentials('django.core.mail.backends.locmem.EmailBackend')
+        recipients = [message.to for message in mail.outbox]
+        self.assertEqual(sorted(recipients), sorted([student.email] for student in self.students))
+        self.assertEqual(User.objects.filter(credentials_sent_at=None).count(), 2)
+
+
+class DataVersionTest(TestCase):
+    """
+    The global data version never repeats, even when universities are deleted.
+    """
+
+    def test_deletions(self):
+        first = University.objects.create(short_name='first', name='First', domain='*')
+        University.objects.create(short_name='second', name='Second', domain='*')
+        versions = [data_version()[0]]
+
+        def change(university):
+            bump_data_version([university.pk])
+            versions.append(data_version()[0])
+
+        change(first)
+        University.objects.get(short_name='second').delete()
+        versions.append(data_version()[0])
+        for _ in range(5):
+            change(first)
+        first.delete()
+        self.assertEqual(data_version(), (None, None))
+
+        third = University.objects.create(short_name='third', name='Third', domain='*')
+        versions.append(data_version()[0])
+        for _ in range(5):
+            change(third)
+        self.assertEqual(len(set(versions)), len(versions), versions)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PageCacheTest(TestCase):
+    """
+    The cached pages and the ETags (of the API too) depend on the parameters
+    read by the views and on the data, not on the rest of the URL.
+    """
+
+    def setUp(self):
+        self.university = University.objects.create(id=1, short_name='uni', name='University', domain='*')
+
+    def etag(self, url):
+        response = self.client.get(url, secure=True)
+        self.assertEqual(response.status_code, 200)
+        return response['ETag']
+
+    def test_unread_parameters(self):
+        url = reverse('university', args=['uni'])
+        self.assertEqual(self.etag(url), self.etag(f'{url}?utm_source=mail'))
+        self.assertNotEqual(self.etag(url), self.etag(f'{url}?teams_after=1'))
+
+    def test_api_unread_parameters(self):
+        url = reverse('api-universities')
+        self.assertEqual(self.etag(url), self.etag(f'{url}?utm_source=mail'))
+        self.assertNotEqual(self.etag(url), self.etag(f'{url}?limit=1'))
+
+    def test_repeated_version(self):
+        # Like after resetting the database: the same data version again
+        etag = self.etag(reverse('index'))
+        version = data_version()[0]
+        self.university.delete()
+        University.objects.create(id=1, short_name='uni', name='University', domain='*')
+        self.assertEqual(data_version()[0], version)
+        self.assertNotEqual(self.etag(reverse('index')), etag)
+
+
+def create_export_data():
+    # Explicit ids, since they are part of the exports
+    universities = {
+        short_name: University.objects.create(id=id, short_name=short_name, name=name, domain='*')
+        for id, short_name, name in [
+            (1, 'unipi', 'Università di Pisa'),
+            (2, 'empty', 'University without students'),
+            (3, 'other', 'Other'),
+            (4, 'polimi', 'Politecnico di Milano'),
+            (5, 'singles', 'University without teams'),
+        ]
+    }
+    teams = {
+        id: Team.objects.create(id=id, name=name, university=universities[university], secret=f'secret-{id}')
+        for id, name, university in [
+            (1, 'Pisa "A"', 'unipi'),
+            (2, 'Pisa B', 'unipi'),
+            (3, 'Outsiders', 'other'),
+            (4, 'Milano', 'polimi'),
+        ]
+    }
+    for id, (university, team, is_verified) in enumerate([
+        ('unipi', 1, True),
+        ('unipi', 1, True),
+        ('unipi', 2, False),
+        ('unipi', None, True),
+        ('unipi', None, False),
+        ('other', 3, True),
+        ('other', None, True),
+        ('polimi', 4, True),
+        ('polimi', 4, True),
+        ('polimi', 4, True),
+        ('singles', None, True),
+        ('singles', None, True),
+    ], start=1):
+        User.objects.create(
+            id=id, email=f'student{id}@example.com', first_name='Studente', last_name=f'Nùmero {id}',
+            university=universities[university], team=teams.get(team), is_verified=is_verified,
+        )
+
+
+class ExportPayloadTest(TestCase):
+    """
+    The organizations and teams exports are the same as the ones of the
+    original per-row implementation, saved in teams/testdata.
+    """
+
+    def setUp(self):
+        create_export_data()
+
+    def assertExport(self, key):
+        filename, chunks = export_chunks(key)
+        self.assertEqual("".join(chunks), (TESTDATA_DIR / filename).read_text())
+
+    def test_organizations(self):
+        self.assertExport('organizations')
+
+    def test_teams(self):
+        self.assertExport('teams')
+
+    def test_job_file(self):
+        # UTF-8 whatever the locale, and the CSV keeps its \r\n line endings
+        artifacts_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, artifacts_dir)
+        with override_settings(ARTIFACTS_DIR=artifacts_dir):
+            artifact = export_job(jobs.enqueue('export', key='accounts-csv'), 'accounts-csv')
+            content = Path(jobs.artifact_path(artifact)).read_bytes()
+        _, chunks = export_chunks('accounts-csv')
+        self.assertEqual(content, "".join(chunks).encode())
+        self.assertIn('Nùmero'.encode(), content)
+
+
+# The emails are stored in the outbox, like in production
+@override_settings(CACHES=NO_CACHE, EMAIL_BACKEND='teams.mail.OutboxEmailBackend')
+class GeneratedDataTestCase(TestCase):
+    """
+    An edition generated by generate_data, and the users making the requests:
+    an 'admin', a team 'member' and a 'single' student of the biggest
+    university, where an N+1 query would hurt the most. The requests come
+    from outside, not from localhost.
+    """
+
+    STUDENTS = 200
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('loaddata', 'universities', stdout=io.StringIO())
+        cls.generate(cls.STUDENTS, SEED)
+        cls.admin = User.objects.create(
+            email='admin@example.org', first_name='Admin', last_name='Admin',
+            university=University.objects.first(), is_verified=True, is_staff=True, is_superuser=True,
+        )
+
+    @classmethod
+    def generate(cls, students, seed):
+        call_command('generate_data', users=students, seed=seed, stdout=io.StringIO())
+
+    def setUp(self):
+        self.created = 0
+        self.pick_users()
+
+    def pick_users(self):
+        self.university = University.objects.order_by('-student_count', 'id').first()
+        self.single = User.objects.filter(university=self.university, team=None, is_verified=True).first()
+        self.member = User.objects.filter(university=self.university, team__isnull=False, is_verified=True).first()
+
+    def client_for(self, user):
+        client = Client(REMOTE_ADDR='203.0.113.1')
+        if user:
+            client.force_login(user)
+        return client
+
+    def email(self):
+        self.created += 1
+        domain = self.university.domain.split(',')[0]
+        return f'test-{self.created}@{"example.org" if domain == "*" else domain}'
+
+    def create_student(self, team=None):
+        return User.objects.create(
+            email=self.email(), first_name='Test', last_name=str(self.created),
+            university=self.university, team=team, is_verified=True,
+        )
+
+    def create_team(self, members):
+        self.created += 1
+        team = Team.objects.create(
+            name=f'Test team {self.created}', university=self.university, secret=get_random_string(16),
+        )
+        for _ in range(members):
+            self.create_student(team)
+        return team
+
+
+class QueryBudgetTest(GeneratedDataTestCase):
+    """
+    Every route of teams/urls.py and every export issues the number of queries
+    in its budget, on a small and on a large dataset: a count that grows with
+    the data is an N+1 query. When a change legitimately needs more queries,
+    update the table in the same commit, so that the change is visible in the
+    review.
+    """
+
+    STUDENTS_LARGE = 2000
+
+    # Who makes the request:
+    # - None: anonymous visitor
+    # - 'member': verified student in a team
+    # - 'single': verified student not in a team
+    # - 'admin': superuser
+    BUDGETS = [
+        # route name              method  data             as        status  queries  ms
+        ('index',                 'GET',  None,            None,     200,    3,       300),
+        ('index',                 'GET',  None,            'member', 200,    3,       300),
+        ('university',            'GET',  None,            None,     200,    5,       500),
+        ('university',            'GET',  None,            'member', 200,    8,       500),
+        ('me',                    'GET',  None,            None,     200,    0,       100),
+        ('me',                    'GET',  None,            'member', 200,    3,       100),
+        ('create-student',        'GET',  None,            None,     200,    2,       300),
+        ('create-student',        'POST', None,            None,     302,    21,      1000),
+        ('my-profile',            'GET',  None,            None,     302,    0,       100),
+        ('my-profile',            'GET',  None,            'member', 200,    5,       300),
+        ('create-team',           'GET',  None,            None,     302,    0,       100),
+        ('create-team',           'GET',  None,            'single', 200,    4,       300),
+        ('create-team',           'POST', None,            'single', 200,    16,      300),
+        ('join-team',             'GET',  None,            None,     302,    0,       100),
+        ('join-team',             'GET',  None,            'single', 200,    5,       300),
+        ('join-team',             'POST', None,            'single', 302,    14,      300),
+        ('leave-team',            'GET',  None,            None,     302,    0,       100),
+        ('leave-team',            'GET',  None,            'member', 200,    4,       300),
+        ('leave-team',            'POST', None,            'member', 302,    13,      300),
+        ('api-universities',      'GET',  None,            None,     200,    2,       300),
+        ('api-university-teams',  'GET',  None,            None,     200,    4,       500),
+        ('api-open-teams',        'GET',  None,            None,     200,    2,       500),
+        ('export-data',           'GET',  None,            None,     302,    0,       100),
+        ('export-data',           'GET',  None,            'admin',  200,    5,       300),
+        ('export-data',           'POST', 'accounts',      'admin',  302,    5,       300),
+        ('job-artifact',          'GET',  None,            None,     302,    0,       100),
+        ('job-artifact',          'GET',  None,            'admin',  200,    3,       300),
+        ('metrics',               'GET',  None,            None,     403,    0,       300),
+        ('metrics',               'GET',  None,            'admin',  200,    2,       300),
+        # Generated by `manage.py run_jobs`, not in a request
+        ('export',                'JOB',  'groups',        None,     None,   0,       300),
+        ('export',                'JOB',  'organizations', None,     None,   1,       1000),
+        ('export',                'JOB',  'teams',         None,     None,   2,       5000),
+        ('export',                'JOB',  'accounts',      None,     None,   5,       10000),
+        ('export',                'JOB',  'accounts-csv',  None,     None,   5,       10000),
+    ]
+
+    def setUp(self):
+        super().setUp()
+        artifacts_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, artifacts_dir)
+        settings = override_settings(ARTIFACTS_DIR=artifacts_dir)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.job = self.create_export_job()
+
+    def create_export_job(self):
+        # A finished export, without running the job (which would also
+        # delete the files of the older exports)
+        filename, chunks = export_chunks('groups')
+        content = "".join(chunks).encode()
+        artifact = os.path.join('test', filename)
+        path = jobs.artifact_path(artifact)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return Job.objects.create(
+            kind='export', args={'key': 'groups'}, created_by=self.admin, status=Job.Status.DONE,
+            artifact=artifact, checksum=hashlib.sha256(content).hexdigest(), size=len(content),
+        )
+
+    def prepare(self, name, method, key, who):
+        """
+        URL, POST data and user of a request. The POSTs that change the team
+        of the user get a new user (and team) every time, so that the measured
+        request does the same work as the warm-up one.
+        """
+        user = getattr(self, who) if who else None
+        data = None
+
+        if name == 'join-team' and method == 'POST':
+            team = self.create_team(1)
+        elif name == 'join-team':
+            team = self.member.team
+        if name in ('university', 'create-student', 'create-team', 'api-university-teams'):
+            url = reverse(name, args=[self.university.short_name])
+        elif name == 'join-team':
+            url = reverse(name, args=[team.secret])
+        elif name == 'job-artifact':
+            url = reverse(name, args=[self.job.pk])
+        else:
+            url = reverse(name)
+
+        if method == 'POST' and name == 'export-data':
+            data = {'key': key}
+        elif method == 'POST' and name == 'create-student':
+            password = get_random_string(16)
+            data = {
+                'first_name': 'Test', 'last_name': 'Student', 'email': self.email(),
+                'password1': password, 'password2': password, 'accept_terms': 'on',
+            }
+        elif method == 'POST' and who == 'single':
+            user = self.create_student()
+            data = {'name': f'Test team {self.created}'}
+        elif method == 'POST' and who == 'member':
+            # Not the last member, who would also delete the team
+            user = self.create_team(2).user_set.first()
+        return url, data, user
+
+    def request(self, name, method, key, who):
+        """
+        The request (or export) of a budget, ready to be sent: returns its
+        status code, None for the exports.
+        """
+        if method == 'JOB':
+            def run():
+                # What the `export` job does, without writing the file
+                _, chunks = export_chunks(key)
+                for _ in chunks:
+                    pass
+            return run
+
+        url, data, user = self.prepare(name, method, key, who)
+        client = self.client_for(user)
+
+        def run():
+            if method == 'POST':
+                response = client.post(url, data, secure=True)
+            else:
+                response = client.get(url, secure=True)
+            if response.streaming:
+                b''.join(response.streaming_content)
+            return response.status_code
+        return run
+
+    def assertWithinBudgets(self):
+        for name, method, key, who, status, queries, ms in self.BUDGETS:
+            with self.subTest(route=f"{method} {name}", data=key, who=who):
+                # Warm up first, so that one-off work (e.g. generating the
+                # missing credentials of the accounts export) is not counted
+                self.request(name, method, key, who)()
+
+                run = self.request(name, method, key, who)
+                with self.assertNumQueries(queries):
+                    start = time.perf_counter()
+                    self.assertEqual(run(), status)
+                    elapsed = (time.perf_counter() - start) * 1000
+                self.assertLessEqual(elapsed, ms)
+
+    def test_every_route_has_a_budget(self):
+        missing = {pattern.name for pattern in urlpatterns} - {budget[0] for budget in self.BUDGETS}
+        self.assertEqual(missing, set())
+
+    def test_budgets(self):
+        self.assertWithinBudgets()
+        self.generate(self.STUDENTS_LARGE - self.STUDENTS, SEED + 1)
+        self.pick_users()
+        self.assertWithinBudgets()
+
+
+class QueryPlanTest(GeneratedDataTestCase):
+    """
+    The queries of the pages use the indexes of the tables that grow with the
+    number of registrations: a sequential scan on any of them means that the
+    cost of a page depends on the size of the edition.
+    """
+
+    BIG_TABLES = ['teams_user', 'teams_team', 'teams_teamjoinevent', 'account_emailaddress']
+
+    def routes(self):
+        return [
+            ('index', None, reverse('index')),
+            ('index', self.member, reverse('index')),
+            ('university', None, reverse('university', args=[self.university.short_name])),
+            ('university', self.member, reverse('university', args=[self.university.short_name])),
+            ('me', self.member, reverse('me')),
+            ('my-profile', self.member, reverse('my-profile')),
+            ('create-team', self.single, reverse('create-team', args=[self.university.short_name])),
+            ('join-team', self.single, reverse('join-team', args=[self.member.team.secret])),
+            ('leave-team', self.member, reverse('leave-team')),
+            ('api-universities', None, reverse('api-universities')),
+            ('api-university-teams', None, reverse('api-university-teams', args=[self.university.short_name])),
+            ('api-open-teams', None, reverse('api-open-teams')),
+            ('export-data', self.admin, reverse('export-data')),
+        ]
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # Only fall back to a sequential scan if there's no index at
+                # all, regardless of how small the generated tables are
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                cursor.execute(f"EXPLAIN {sql}")
+                plan = "\n".join(row[0] for row in cursor.fetchall())
+                cursor.execute("RESET enable_seqscan")
+            else:
+                cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+                plan = "\n".join(row[-1] for row in cursor.fetchall())
+        return plan
+
+    def has_seq_scan(self, plan):
+        for line in plan.splitlines():
+            for table in self.BIG_TABLES:
+                if connection.vendor == 'postgresql':
+                    if f"Seq Scan on {table}" in line:
+                        return True
+                elif line.strip().startswith(f"SCAN {table}") and "INDEX" not in line:
+                    return True
+        return False
+
+    def test_no_seq_scans(self):
+        for name, user, url in self.routes():
+            with self.subTest(route=name, user=user):
+                client = self.client_for(user)
+                with CaptureQueriesContext(connection) as ctx:
+                    response = client.get(url, secure=True)
+                self.assertEqual(response.status_code, 200)
+
+                for query in ctx.captured_queries:
+                    sql = query['sql']
+                    if sql.lstrip().upper().startswith('SELECT'):
+                        plan = self.explain(sql)
+                        self.assertFalse(self.has_seq_scan(plan), f"{sql}\n{plan}")
+
+
+def reference_export(key):
+    """
+    The export `key` generated like the original per-row implementation did
+    (ordered by id, which it relied on the database for), to check the
+    streamed one against it.
+    """
+    if key == 'organizations':
+        rows = []
+        for university in University.objects.order_by('id'):
+            if User.objects.filter(university=university).count() > 0:
+                rows.append({
+                    "id": university.short_name,
+                    "icpc_id": university.short_name,
+                    "name": university.short_name,
+                    "formal_name": university.name,
+                    "country": "ITA",
+                })
+    elif key == 'teams':
+        rows = []
+        for team in Team.objects.order_by('id'):
+            team_id = f"itacpc-team-{team.id}"
+            rows.append({
+                "id": team_id,
+                "icpc_id": team_id,
+                "group_ids": ['1002' if team.university.short_name == 'other' else '1001'],
+                "name": team.name,
+                "organization_id": team.university.short_name,
+            })
+        for user in User.objects.filter(team=None).order_by('id'):
+            if not user.is_verified:
+                continue
+            team_id = f"itacpc-single-{user.id}"
+            rows.append({
+                "id": team_id,
+                "icpc_id": team_id,
+                "group_ids": ['1002' if user.university.short_name == 'other' else '1001'],
+                "name": user.full_name,
+                "organization_id": user.university.short_name,
+            })
+    else:
+        rows = []
+        for user in User.objects.order_by('id'):
+            if not user.is_verified:
+                continue
+            user_emails = map(str, EmailAddress.objects.filter(verified=True, user=user).order_by('id'))
+            obj = {
+                "id": f"itacpc-user-{user.id}",
+                "username": user.credentials['username'],
+                "password": user.credentials['password'],
+                "email": ",".join(user_emails),
+                "type": "team",
+                "name": user.full_name,
+                "team_id": f"itacpc-team-{user.team.id}" if user.team else f"itacpc-single-{user.id}",
+            }
+            if key == 'accounts-csv':
+                obj["team_name"] = user.team.name if user.team else user.full_name
+            rows.append(obj)
+
+    if key == 'accounts-csv':
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=['email', 'name', 'team_name', 'username', 'password'], extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+        return output.getvalue()
+    return json.dumps(rows, indent=4)
+
+
+class ExportEquivalenceTest(GeneratedDataTestCase):
+    """
+    The streamed exports are the same as the ones of the original per-row
+    implementation on a generated edition, bigger than a chunk of the
+    server-side cursors.
+    """
+
+    STUDENTS = 3000
+
+    def assertExport(self, key):
+        _, chunks = export_chunks(key)
+        # The streamed export stores the missing credentials first, the
+        # original implementation did it row by row
+        exported = "".join(chunks)
+        self.assertEqual(exported, reference_export(key))
+
+    def test_organizations(self):
+        self.assertExport('organizations')
+
+    def test_teams(self):
+        self.assertExport('teams')
+
+    def test_accounts(self):
+        self.assertExport('accounts')
+
+    def test_accounts_csv(self):
+        self.assertExport('accounts-csv')
+
+
+def expiring_job(job, expire):
+    # With `expire`, runs past RUNNING_TIMEOUT and gets expired (see
+    # jobs.expire) before it ends
+    artifact = os.path.join('jobs', str(job.pk), 'result.txt')
+    os.makedirs(os.path.dirname(jobs.artifact_path(artifact)))
+    with open(jobs.artifact_path(artifact), 'w') as f:
+        f.write("result")
+    if expire:
+        Job.objects.filter(pk=job.pk).update(started_at=job.started_at - jobs.RUNNING_TIMEOUT)
+        jobs.expire()
+    return artifact
+
+
+@mock.patch.dict(jobs.KINDS, {'expiring': 'teams.tests.expiring_job'})
+class JobRunTest(TestCase):
+    """
+    A job that expired while running stays failed, without its file.
+    """
+
+    def setUp(self):
+        artifacts_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, artifacts_dir)
+        settings = override_settings(ARTIFACTS_DIR=artifacts_dir)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def run_job(self, expire):
+        job = jobs.enqueue('expiring', expire=expire)
+        self.assertEqual(jobs.claim(1), [job.pk])
+        jobs.run(job.pk)
+        job.refresh_from_db()
+        return job
+
+    def test_finished(self):
+        job = self.run_job(expire=False)
+        self.assertEqual(job.status, Job.Status.DONE)
+        self.assertTrue(os.path.exists(jobs.artifact_path(job.artifact)))
+
+    def test_expired(self):
+        with self.assertLogs('teams.jobs', 'WARNING'):
+            job = self.run_job(expire=True)
+        self.assertEqual(job.status, Job.Status.FAILED)
+        self.assertEqual(job.artifact, '')
+        self.assertFalse(os.path.exists(jobs.artifact_path(os.path.join('jobs', str(job.pk)))))
+
+
+# SQLite runs the transactions one at a time, so nothing would be raced
+@skipUnless(connection.vendor == 'postgresql', "needs PostgreSQL")
+class TeamMembershipConcurrencyTest(TransactionTestCase):
+    """
+    Joins and leaves sent at the same time, like during the registration rush
+    or on a double submit, never overfill a team or move its member_count
+    away from the actual number of members.
+    """
+
+    # Students of the stress test, each of them joining, leaving and joining
+    # again, and the requests sent in parallel
+    STRESS_STUDENTS = 300
+    STRESS_THREADS = 30
+    # Minimum throughput of the stress test, in requests per second
+    STRESS_MIN_THROUGHPUT = 50
+
+    def setUp(self):
+        self.university = University.objects.create(short_name='uni', name='University', domain='*')
+        self.users = [self.create_student(i) for i in range(8)]
+
+    def create_student(self, i):
+        return User.objects.create(
+            email=f'student{i}@example.com', first_name='Student', last_name=str(i),
+            university=self.university, is_verified=True,
+        )
+
+    def create_team(self, name, *members):
+        team = Team.objects.create(name=name, university=self.university, secret=f'secret-{name}')
+        for user in members:
+            user.team = team
+            user.save()
+        return team
+
+    def logged_in(self, user):
+        client = Client()
+        client.force_login(user)
+        return client
+
+    def post(self, client, url, data=None):
+        try:
+            return client.post(url, data, secure=True).status_code
+        except Exception as e:
+            return e
+
+    def concurrently(self, requests):
+        """
+        Send the (user, url[, data]) POST requests at the same time, each from
+        its own thread and DB connection, check that none of them fails.
+        """
+        clients = [self.logged_in(user) for user, *_ in requests]
+        barrier = threading.Barrier(len(requests))
+        responses = [None] * len(requests)
+
+        def post(i, client, url, data=None):
+            barrier.wait()
+            responses[i] = self.post(client, url, data)
+            # Every thread has its own DB connection
+            connections.close_all()
+
+        threads = [
+            threading.Thread(target=post, args=(i, client, *request[1:]))
+            for i, (client, request) in enumerate(zip(clients, requests))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for response in responses:
+            self.assertIn(response, (200, 302))
+
+    def assertCountersMatch(self):
+        for team in Team.objects.all():
+            members = User.objects.filter(team=team).count()
+            self.assertLessEqual(members, MAX_TEAM_MEMBERS, team)
+            self.assertEqual(team.member_count, members, team)
+
+    def test_joins_fill_the_team_once(self):
+        team = self.create_team('full', self.users[0])
+        join = reverse('join-team', args=[team.secret])
+
+        self.concurrently([(user, join) for user in self.users[1:]])
+
+        self.assertEqual(User.objects.filter(team=team).count(), MAX_TEAM_MEMBERS)
+        self.assertCountersMatch()
+
+    def test_double_leave(self):
+        team = self.create_team('pair', self.users[0], self.users[1])
+        leave = reverse('leave-team')
+
+        self.concurrently([(self.users[0], leave)] * 2)
+
+        self.assertTrue(Team.objects.filter(pk=team.pk).exists())
+        self.assertEqual(list(User.objects.filter(team=team)), [self.users[1]])
+        self.assertCountersMatch()
+
+    def test_double_leave_of_the_last_member(self):
+        team = self.create_team('alone', self.users[0])
+
+        self.concurrently([(self.users[0], reverse('leave-team'))] * 2)
+
+        self.assertFalse(Team.objects.filter(pk=team.pk).exists())
+        self.assertCountersMatch()
+
+    def test_join_two_teams_at_once(self):
+        first = self.create_team('first', self.users[0])
+        second = self.create_team('second', self.users[1])
+        user = self.users[2]
+
+        self.concurrently([
+            (user, reverse('join-team', args=[first.secret])),
+            (user, reverse('join-team', args=[second.secret])),
+            (user, reverse('create-team', args=[self.university.short_name]), {'name': 'third'}),
+        ])
+
+        self.assertEqual(User.objects.filter(pk=user.pk, team__isnull=False).count(), 1)
+        self.assertCountersMatch()
+
+    def test_stress(self):
+        # Few teams for many students, so that most joins race for a place
+        rng = random.Random(0)
+        students = [self.create_student(i) for i in range(len(self.users), len(self.users) + self.STRESS_STUDENTS)]
+        teams = [self.create_team(f'team{i}', user) for i, user in enumerate(self.users)]
+        leave = reverse('leave-team')
+
+        def attempts(student):
+            client = self.logged_in(student)
+            first, second = rng.sample(teams, 2)
+            return [(client, first), (client, None), (client, second)]
+
+        def url(team):
+            if team is None:
+                return leave
+            # Leaving changes the secret of the team, like sharing the new
+            # link again would
+            return reverse('join-team', args=[Team.objects.values_list('secret', flat=True).get(pk=team.pk)])
+
+        work = [attempts(student) for student in students]
+        responses = []
+
+        def run(share):
+            for attempts in share:
+                responses.extend(self.post(client, url(team)) for client, team in attempts)
+            # Every thread has its own DB connection
+            connections.close_all()
+
+        threads = [threading.Thread(target=run, args=(work[i::self.STRESS_THREADS],)) for i in range(self.STRESS_THREADS)]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(len(responses), 3 * self.STRESS_STUDENTS)
+        for response in responses:
+            # A secret can still change between reading and joining
+            self.assertIn(response, (200, 302, 404))
+        self.assertCountersMatch()
+        # The joins did race for the last places
+        self.assertTrue(Team.objects.filter(member_count=MAX_TEAM_MEMBERS).exists())
+        throughput = len(responses) / elapsed
+        self.assertGreaterEqual(
+            throughput, self.STRESS_MIN_THROUGHPUT, f"{len(responses)} requests in {elapsed:.1f}s",
+        )
@@ -1,13 +1,19 @@
 from django.urls import path
 
-from . import views
+from . import api, views
 
 urlpatterns = [
     path("", views.index, name="index"),
     path("export", views.export_data, name="export-data"),
+    path("export/<int:job_id>", views.job_artifact, name="job-artifact"),
     path("my-profile", views.my_profile, name="my-profile"),
     path("leave-team", views.leave_team, name="leave-team"),
     path("join/<secret>", views.join_team, name="join-team"),
+    path("metrics", views.prometheus_metrics, name="metrics"),
+    path("me.json", views.me, name="me"),
+    path("api/universities", api.universities, name="api-universities"),
+    path("api/universities/<university_short_name>/teams", api.university_teams, name="api-university-teams"),
+    path("api/open-teams", api.open_teams, name="api-open-teams"),
     path("<university_short_name>", views.university, name="university"),
     path("<university_short_name>/new-student", views.create_student, name="create-student"),
     path("<university_short_name>/new-team", views.create_team, name="create-team"),
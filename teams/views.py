@@ -1,21 +1,25 @@
-import csv
-import io
-import json
+import base64
+import mimetypes
 
-from allauth.account.models import EmailAddress
 from django import forms
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth.models import User
-from django.core.exceptions import SuspiciousOperation
+from django.core.exceptions import PermissionDenied, SuspiciousOperation
 from django.db import transaction
-from django.db.models import Count
+from django.db.models import Prefetch
 from django.shortcuts import get_object_or_404, redirect, render
-from django.http import HttpResponse, HttpResponsePermanentRedirect, HttpResponseRedirect
+from django.http import FileResponse, Http404, HttpResponse, HttpResponsePermanentRedirect, HttpResponseRedirect, JsonResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import content_disposition_header, quote_etag
 from django.utils.crypto import get_random_string
-from teams.models import TeamJoinEvent, User, Team, University
+from teams import jobs, metrics
+from teams.credentials import credentials_for
+from teams.exports import EXPORTS, current_export, export_versions
+from teams.pagecache import page_query, versioned_page
+from teams.models import MAX_TEAM_MEMBERS, MEMBER_COLUMNS, Job, TeamJoinEvent, User, Team, University, data_version, university_data_version
 from allauth.account.views import SignupView
 from allauth.account.forms import SignupForm
 from allauth.account.adapter import get_adapter
@@ -35,36 +39,43 @@ def _ajax_response(request, response, form=None, data=None):
     return response
 
 
+# The same for everyone, so that it can be cached by nginx too: the university
+# of the logged in user is moved first and highlighted in the browser (see `me`)
+@versioned_page(data_version, personalized=False)
 def index(request):
-    user_own_university = None
-    if request.user.is_authenticated and hasattr(request.user, 'university'):
-        user_own_university = request.user.university
-
-    unis_with_count = University.objects.annotate(teams=Count('team', distinct=True), students=Count('user', distinct=True))
-    other_university = unis_with_count.filter(short_name='other').first()
+    other_university = University.objects.filter(short_name='other').first()
 
     # List all university except the "other" one
-    unis = unis_with_count.exclude(short_name='other').order_by('-teams', '-students', 'short_name').all()
+    unis = University.objects.exclude(short_name='other').order_by('-team_count', '-student_count', 'short_name').all()
 
     # Put "other" university first if it exists
     if other_university:
         unis = [other_university] + list(unis)
 
-    # If user has university, put that one first
-    if user_own_university:
-        unis = list(filter(lambda u: u == user_own_university, unis)) + \
-            list(filter(lambda u: u != user_own_university, unis))
-
-    team_count = Team.objects.count()
-    students_count = User.objects.count()
+    team_count = sum(u.team_count for u in unis)
+    students_count = sum(u.student_count for u in unis)
 
     return render(request, "teams/index.html", {
         "unis": unis,
-        "user_own_university": user_own_university,
         "team_count": team_count,
         "students_count": students_count,
     })
 
+def me(request):
+    user = request.user
+    if not user.is_authenticated:
+        data = {"authenticated": False}
+    else:
+        data = {
+            "authenticated": True,
+            "is_staff": user.is_staff,
+            "university": user.university.short_name if user.university_id else None,
+        }
+
+    response = JsonResponse(data)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
 @login_required
 def my_profile(request):
     class ProfileForm(forms.ModelForm):
@@ -88,9 +99,33 @@ def my_profile(request):
             "student": student,
             "university": university,
             "form": form,
-            "can_disclose_credentials": settings.CAN_DISCLOSE_CREDENTIALS,
+            "credentials": credentials_for(student) if settings.CAN_DISCLOSE_CREDENTIALS and student.is_verified else None,
         })
 
+# Teams and individual participants shown at a time on the university page
+UNIVERSITY_PAGE_SIZE = 100
+
+def _keyset_page(request, queryset, cursor):
+    """
+    The rows of `queryset` after the id in the `cursor` parameter, and the
+    query string of the next page (None on the last page).
+    """
+    try:
+        after = int(request.GET.get(cursor, 0))
+    except ValueError:
+        after = 0
+
+    rows = list(queryset.filter(id__gt=after).order_by('id')[:UNIVERSITY_PAGE_SIZE + 1])
+    if len(rows) <= UNIVERSITY_PAGE_SIZE:
+        return rows, None
+
+    rows = rows[:UNIVERSITY_PAGE_SIZE]
+    query = page_query(request)
+    query[cursor] = rows[-1].id
+    query.pop('fragment', None)
+    return rows, f"?{query.urlencode()}"
+
+@versioned_page(university_data_version)
 def university(request, university_short_name):
     university = get_object_or_404(University, short_name=university_short_name)
     user_own_team = None
@@ -100,20 +135,30 @@ def university(request, university_short_name):
             # if team:
         user_own_team = request.user.team
 
-    teams = Team.objects.filter(university=university).all()
-    grouped = []
-    for t in teams:
-        students = User.objects.filter(team=t).all()
-        grouped.append((t, students))
-
-    students_left = User.objects.filter(team=None, university=university).all()
-
-    return render(request, "teams/university.html", {
-        "students_left": students_left,
-        "grouped": grouped,
+    context = {
         "university": university,
         "user_own_team": user_own_team,
-    })
+    }
+
+    # Both lists are paginated separately, and the "show more" links of the
+    # page only ask for the next rows of one of them (the `fragment`)
+    fragment = request.GET.get('fragment')
+
+    if fragment != 'students':
+        teams = Team.objects.filter(university=university).only('name').prefetch_related(
+            Prefetch('user_set', queryset=User.objects.only(*MEMBER_COLUMNS).order_by('team', 'id')),
+        )
+        teams, context["next_teams"] = _keyset_page(request, teams, 'teams_after')
+        context["grouped"] = [(t, t.user_set.all()) for t in teams]
+
+    if fragment != 'teams':
+        students_left = User.objects.filter(team=None, university=university).only(*MEMBER_COLUMNS)
+        context["students_left"], context["next_students"] = _keyset_page(request, students_left, 'students_after')
+
+    if fragment in ('teams', 'students'):
+        return render(request, f"teams/university_{fragment}.html", context)
+
+    return render(request, "teams/university.html", context)
 
 class StudentSignUpView(SignupView):
     class UserForm(SignupForm):
@@ -156,9 +201,11 @@ class StudentSignUpView(SignupView):
             raise forms.ValidationError('Use your institutional email address')
         
         def save(self, request):
-            user = super().save(request)
-            user.university = self.university
-            user.save()
+            # The university counters are updated together with the user
+            with transaction.atomic():
+                user = super().save(request)
+                user.university = self.university
+                user.save()
             return user
 
 
@@ -235,16 +282,26 @@ def create_team(request, university_short_name):
         form = TeamForm(request.POST)
 
         if form.is_valid():
-            team = form.save()
-            team.university = university
-            team.secret = get_random_string(length=16)
-            team.save()
-
-            request.user.team = team
-            request.user.save()
+            # Run in a transaction so that the team is created together with
+            # the university counters and the membership
+            with transaction.atomic():
+                # Lock the user and check again: request.user was loaded
+                # before any concurrent join (e.g. a double submit)
+                user = User.objects.select_for_update().get(pk=request.user.pk)
+                if user.team_id:
+                    messages.error(request, 'You are already in a team, to create a new team you should first leave your current one.')
+                    return redirect('my-profile')
+
+                team = form.save(commit=False)
+                team.university = university
+                team.secret = get_random_string(length=16)
+                team.save()
+
+                user.team = team
+                user.save()
 
-            event = TeamJoinEvent(user=request.user, team=team, joining=True)
-            event.save()
+                event = TeamJoinEvent(user=user, team=team, joining=True)
+                event.save()
 
             return render(request, "teams/university_team_created.html", {
                 "team": team,
@@ -260,8 +317,6 @@ def create_team(request, university_short_name):
 
 @login_required
 def join_team(request, secret):
-    MAX_MEMBERS = 3
-
     if settings.REGISTRATION_IS_CLOSED:
         messages.error(request, 'It is too late now to make changes to the teams.')
         return redirect('my-profile')
@@ -281,18 +336,29 @@ def join_team(request, secret):
         return redirect('my-profile')
 
     if request.method == "POST":
-        # Run in a transaction to avoid race condition (e.g. someone joins the
+        # Lock the team row to avoid race conditions (e.g. someone joins the
         # same team right after we verified that the team is not already full)
         with transaction.atomic():
-            num_members = User.objects.filter(team=team).count()
-            if num_members >= MAX_MEMBERS:
+            # Lock the user first (like leave_team) and check again:
+            # request.user was loaded before any concurrent join or leave
+            user = User.objects.select_for_update().get(pk=request.user.pk)
+            if user.team_id:
+                messages.info(request, 'You can\'t join a new team, you should first leave your current team.')
+                return redirect('my-profile')
+
+            team = Team.objects.select_for_update().filter(pk=team.pk).first()
+            if team is None:
+                # The last member left (and deleted the team) in the meantime
+                messages.error(request, 'This team does not exist anymore')
+                return redirect('my-profile')
+            if team.member_count >= MAX_TEAM_MEMBERS:
                 messages.error(request, 'This team has reached the maximum number of members')
                 return redirect('my-profile')
-            
-            request.user.team = team
-            request.user.save()
 
-            event = TeamJoinEvent(user=request.user, team=team, joining=True)
+            user.team = team
+            user.save()
+
+            event = TeamJoinEvent(user=user, team=team, joining=True)
             event.save()
 
             messages.error(request, 'You successfully joined the team!')
@@ -309,152 +375,108 @@ def leave_team(request):
             messages.error(request, 'It is too late now to make changes to the teams.')
             return redirect('my-profile')
 
-        # Run in a transaction to prevent race conditions (e.g. someone else
+        if not request.user.team_id:
+            return redirect('my-profile')
+
+        # Lock the team row to prevent race conditions (e.g. someone else
         # joins the team right before we check if the team is empty)
         with transaction.atomic():
-            old_team = request.user.team
+            # Lock the user and check again: request.user was loaded before
+            # any concurrent leave (e.g. a double submit), which may also
+            # have deleted the team
+            user = User.objects.select_for_update().get(pk=request.user.pk)
+            if not user.team_id:
+                return redirect('my-profile')
 
-            event = TeamJoinEvent(user=request.user, team=old_team, joining=False)
+            old_team = Team.objects.select_for_update().get(pk=user.team_id)
+
+            event = TeamJoinEvent(user=user, team=old_team, joining=False)
             event.save()
 
-            request.user.team = None
-            request.user.save()
+            user.team = None
+            user.save()
 
-            num_members_left = User.objects.filter(team=old_team).count()
-            if num_members_left == 0:
+            old_team.refresh_from_db(fields=['member_count'])
+            if old_team.member_count == 0:
                 old_team.delete()
             else:
                 # Update secret for extra security
                 old_team.secret = get_random_string(length=16)
-                old_team.save()
+                old_team.save(update_fields=['secret'])
 
         return redirect('my-profile')
 
     return render(request, "teams/leave_team.html")
 
-def download_json_as_file(data, filename):
-    response = HttpResponse(json.dumps(data, indent=4))
-    response['Content-Disposition'] = f'attachment; filename={filename}'
-    return response
-
-def download_csv_as_file(data, filename):
-    output = io.StringIO()
-    fieldnames = ['email', 'name', 'team_name', 'username', 'password']
-    writer = csv.DictWriter(output, fieldnames=fieldnames, extrasaction='ignore')
-    writer.writeheader()
-    writer.writerows(data)
-    response = HttpResponse(output.getvalue())
-    response['Content-Disposition'] = f'attachment; filename={filename}'
-    return response
+# Recent exports listed on the export page
+EXPORT_JOBS_SHOWN = 20
 
 @staff_member_required
 @user_passes_test(lambda u: u.is_superuser, login_url='/')
 def export_data(request):
-    if request.method == "GET":
-        return render(request, "teams/export_data.html")
-
-    key = request.POST['key']
-
-    if key == 'groups':
-        groups = [{
-            "id": "1001",
-            "icpc_id": "1001",
-            "name": "ITACPC students",
-            "sortorder": 1,
-        }, {
-            "id": "1002",
-            "icpc_id": "1002",
-            "name": "ITACPC non-students",
-            "sortorder": 2,
-        }]
-        return download_json_as_file(groups, 'groups.json')
-    
-    elif key == 'organizations':
-        organizations = []
-
-        for university in University.objects.all():
-            if User.objects.filter(university=university).count() > 0:
-                organizations.append({
-                    "id": university.short_name,
-                    "icpc_id": university.short_name,
-                    "name": university.short_name,
-                    "formal_name": university.name,
-                    "country": "ITA",
-                })
-        return download_json_as_file(organizations, 'organizations.json')
-    
-    elif key == 'teams':
-        teams = []
-
-        for team in Team.objects.all():
-            team_id = f"itacpc-team-{team.id}"
-
-            teams.append({
-                "id": team_id,
-                "icpc_id": team_id,
-                "group_ids": ['1002' if team.university.short_name == 'other' else '1001'],
-                "name": team.name,
-                "organization_id": team.university.short_name,
-            })
-
-        # Create a fake team for the single users
-        for user in User.objects.filter(team=None).all():
-            if not user.is_verified:
-                continue
-
-            team_id = f"itacpc-single-{user.id}"
-
-            teams.append({
-                "id": team_id,
-                "icpc_id": team_id,
-                "group_ids": ['1002' if user.university.short_name == 'other' else '1001'],
-                "name": user.full_name,
-                "organization_id": user.university.short_name,
-            })
-
-        return download_json_as_file(teams, 'teams.json')
+    # The exports are generated by `manage.py run_jobs`, so that big ones
+    # don't tie up a gunicorn worker (or hit the timeouts)
+    versions = export_versions()
 
-    elif key == 'accounts' or key == 'accounts-csv':
-        accounts = []
-
-        for user in User.objects.all():
-            if not user.is_verified:
-                continue
+    if request.method == "POST":
+        key = request.POST['key']
+        if key not in EXPORTS:
+            raise SuspiciousOperation('Invalid request')
 
-            user_id = f"itacpc-user-{user.id}"
+        if current_export(key, versions[key]):
+            messages.info(request, f"{EXPORTS[key][0]} is up to date.")
+        else:
+            if not jobs.pending('export', key=key).exists():
+                jobs.enqueue('export', request.user, key=key)
+        return redirect('export-data')
+
+    # Only the few latest files of each export are kept (see exports.EXPORTS_KEPT)
+    latest = {}
+    for job in Job.objects.filter(kind='export', status=Job.Status.DONE).exclude(artifact='').order_by('id'):
+        latest[job.args['key']] = job
+
+    recent = list(Job.objects.filter(kind='export').order_by('-id')[:EXPORT_JOBS_SHOWN])
+    return render(request, "teams/export_data.html", {
+        "exports": [{
+            "key": key,
+            "filename": filename,
+            "job": latest.get(key),
+            "current": key in latest and latest[key].version == versions[key],
+        } for key, (filename, _) in EXPORTS.items()],
+        "jobs": recent,
+        "in_progress": any(job.status in (Job.Status.QUEUED, Job.Status.RUNNING) for job in recent),
+    })
 
-            # Generate credentials only once per user (so that we can request
-            # accounts.json multiple times without getting different results)
-            if not user.credentials:
-                user.credentials = {
-                    "username": user_id,
-                    "password": get_random_string(8),
-                }
-                user.save()
-            
-            user_emails = map(str, EmailAddress.objects.filter(verified=True, user=user).all())
-
-            # Add all fields that are used by DOMJudge
-            obj = {
-                "id": user_id,
-                "username": user.credentials['username'],
-                "password": user.credentials['password'],
-                "email": ",".join(user_emails),
-                "type": "team",
-                "name": user.full_name,
-                "team_id": f"itacpc-team-{user.team.id}" if user.team else f"itacpc-single-{user.id}",
-            }
-
-            # Add fields that are used by Mailipy
-            if key == "accounts-csv":
-                obj["team_name"] = user.team.name if user.team else user.full_name
-
-            accounts.append(obj)
-        
-        if key == 'accounts-csv':
-            return download_csv_as_file(accounts, 'accounts.csv')
+@staff_member_required
+@user_passes_test(lambda u: u.is_superuser, login_url='/')
+def job_artifact(request, job_id):
+    job = get_object_or_404(Job, pk=job_id, status=Job.Status.DONE)
+    if not job.artifact:
+        raise Http404()
+
+    # The file of a job never changes, so its checksum is a strong ETag
+    etag = quote_etag(job.checksum)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        if settings.ARTIFACTS_ACCEL_REDIRECT:
+            # nginx sends the file (see the internal location in nginx/itacpc)
+            content_type, _ = mimetypes.guess_type(job.artifact_name)
+            response = HttpResponse(content_type=content_type or 'application/octet-stream')
+            response['X-Accel-Redirect'] = settings.ARTIFACTS_ACCEL_REDIRECT + job.artifact
+            response['Content-Disposition'] = content_disposition_header(True, job.artifact_name)
         else:
-            return download_json_as_file(accounts, 'accounts.json')
+            try:
+                response = FileResponse(open(jobs.artifact_path(job.artifact), 'rb'), as_attachment=True, filename=job.artifact_name)
+            except FileNotFoundError:
+                raise Http404()
+
+    response['ETag'] = etag
+    response['Repr-Digest'] = f"sha-256=:{base64.b64encode(bytes.fromhex(job.checksum)).decode()}:"
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
-    else:
-        raise SuspiciousOperation('Invalid request')
+def prometheus_metrics(request):
+    if not (request.user.is_staff or metrics.is_local(request)):
+        raise PermissionDenied()
+
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')